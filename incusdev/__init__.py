@@ -1,3 +1,35 @@
-from .host import run_local_cmd, run_local_gui_cmd, run_local_cmd_realtime
-from .client import RemoteClient, myRemoteException
-from .log import LOGGER
\ No newline at end of file
+import importlib
+
+# everything is imported on first use rather than up front, as paramiko and loguru
+# take a while to import, and quick CLI tasks (e.g. get_remote_working_directory,
+# which is called inside $(...) in scripts) shouldn't have to wait for them
+_lazy_attributes = {
+	"run_local_cmd": ".host",
+	"run_local_gui_cmd": ".host",
+	"run_local_cmd_realtime": ".host",
+	"RemoteClient": ".client",
+	"myRemoteException": ".client",
+	"CommandResult": ".client",
+	"ContainerPool": ".pool",
+	"TelemetryCollector": ".telemetry",
+	"SyncResult": ".progress",
+	"RsyncError": ".progress",
+	"OutputPipeline": ".output_filters",
+	"LOGGER": ".log",
+}
+
+def __getattr__(name):
+	if name in _lazy_attributes:
+		value = getattr(importlib.import_module(_lazy_attributes[name], __name__), name)
+	else:
+		try:
+			value = importlib.import_module("." + name, __name__) # a submodule, e.g. incusdev.paths
+		except ModuleNotFoundError as e:
+			if e.name != f"{__name__}.{name}":
+				raise # the submodule exists, but something it imports doesn't
+			raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	globals()[name] = value
+	return value
+
+def __dir__():
+	return sorted(list(globals()) + list(_lazy_attributes))
@@ -0,0 +1,188 @@
+"""Pull selected files back out of the container over sftp, with many reads in flight at once."""
+import os, mmap, json, shlex, hashlib, threading, time, posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from .log import LOGGER
+from .progress import SyncResult
+
+CHUNK_BYTES = 16*1024*1024 # big files are split into chunks of this size, which are read in parallel
+REQUEST_BYTES = 32*1024 # each chunk is read as pipelined requests of this size (about the largest an sftp server will answer)
+WORKERS = 4
+
+# which chunks of an interrupted pull already arrived, so trying again only fetches the rest
+CHECKPOINT_DIR = "~/.cache/incusdev/pull_checkpoints"
+CHECKPOINT_INTERVAL_SEC = 1
+
+# files are downloaded next to their destination under this suffix, and only renamed into place once complete
+PART_SUFFIX = ".incusdev-part"
+
+GLOB_CHARS = "*?[]"
+
+def get_part_path(local_path):
+	return local_path + PART_SUFFIX
+
+def quote_glob(pattern):
+	""" Quote a glob pattern for bash, leaving only the glob characters unquoted so they still expand. """
+	quoted = ""
+	literal = ""
+	for char in pattern:
+		if char in GLOB_CHARS:
+			quoted += (shlex.quote(literal) if literal else "") + char
+			literal = ""
+		else:
+			literal += char
+	return quoted + (shlex.quote(literal) if literal else "")
+
+def get_checkpoint_path(remote_dir, local_dir):
+	key = hashlib.sha1(f"{remote_dir}\0{local_dir}".encode("utf-8")).hexdigest()[:16]
+	return os.path.join(os.path.expanduser(CHECKPOINT_DIR), key + ".json")
+
+def load_checkpoint(path):
+	""" {relative path: {"size", "mtime", "done": [chunk offsets]}}, or {} if there isn't a usable one. """
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def save_checkpoint(path, content):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path + ".tmp", "w") as f:
+		json.dump(content, f)
+	os.replace(path + ".tmp", path) # so an interruption while saving can't leave half a checkpoint
+
+def is_inside(path):
+	""" Whether a relative path stays inside the directory it's relative to, e.g. not "/tmp/x" or "../x". """
+	path = posixpath.normpath(path)
+	return not posixpath.isabs(path) and path != ".." and not path.startswith("../")
+
+def resolve_remote_globs(ssh_client, remote_dir, patterns):
+	"""
+	Expand glob patterns (relative to remote_dir, ** allowed) in the container with one command.
+	Matched directories contribute every file under them.
+	Returns a list of (relative path, size, mtime), without duplicates.
+	Raises if a pattern matches anything outside remote_dir, as it would be pulled outside the local directory too.
+	"""
+	script = (f"cd {shlex.quote(remote_dir)} && for f in {' '.join(quote_glob(p) for p in patterns)}; do "
+		"[ -e \"$f\" ] && find \"$f\" -type f -printf '%s\\t%T@\\t%p\\0'; done; true")
+	stdin, stdout, stderr = ssh_client.exec_command(f"bash -O globstar -O nullglob -c {shlex.quote(script)}")
+	raw = stdout.read()
+	if stdout.channel.recv_exit_status() != 0:
+		raise RuntimeError(f"Failed to resolve {patterns} in {remote_dir}: {stderr.read().decode('utf-8', errors='replace').strip()}")
+
+	files = {}
+	for entry in raw.decode("utf-8", errors="surrogateescape").split("\0"):
+		if entry:
+			size, mtime, path = entry.split("\t", 2)
+			files[posixpath.normpath(path)] = (int(size), float(mtime))
+
+	outside = [path for path in files if not is_inside(path)]
+	if outside:
+		raise RuntimeError(f"{patterns} matched files outside {remote_dir}, which won't be pulled: {outside[:5]}")
+	return [(path, size, mtime) for path, (size, mtime) in sorted(files.items())]
+
+def pull_files(ssh_client, remote_dir, local_dir, files, workers=WORKERS, chunk_bytes=CHUNK_BYTES, request_bytes=REQUEST_BYTES, checkpoint_path=None):
+	"""
+	Download files (as returned by resolve_remote_globs) from remote_dir into local_dir.
+
+	Each file is downloaded into a preallocated part file next to its destination, filled in
+	by a pool of worker threads, each with its own sftp session over the one ssh transport.
+	Work is split into chunks, so several files, and several parts of one big file, are read
+	at once, and each chunk is read with readv so many requests are in flight instead of one
+	at a time. A worker maps just the chunk it's writing, so only as many files are open as
+	there are workers. The part files replace the destinations once everything has arrived,
+	so an interrupted pull never leaves a good local copy truncated.
+
+	With a checkpoint_path, the chunks that have arrived are recorded as it goes, and a
+	later call for the same files (unchanged in the container) skips them.
+	"""
+	assert chunk_bytes % mmap.ALLOCATIONGRANULARITY == 0, f"chunk_bytes must be a multiple of {mmap.ALLOCATIONGRANULARITY} to map chunks on their own"
+	result = SyncResult()
+	start_time = time.time()
+	checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path else {}
+
+	# preallocate every part file up front, so the workers only ever copy bytes into place
+	work = []
+	done = {} # {path: set of chunk offsets that have been written}
+	for path, size, mtime in files:
+		assert is_inside(path), f"Not pulling {path}, it's outside {local_dir}"
+		part_path = get_part_path(os.path.join(local_dir, path))
+		os.makedirs(os.path.dirname(part_path), exist_ok=True)
+		previous = checkpoint.get(path)
+		resuming = (previous is not None and previous["size"] == size and previous["mtime"] == mtime
+			and os.path.exists(part_path) and os.path.getsize(part_path) == size)
+		done[path] = set(previous["done"]) if resuming else set()
+		if not resuming:
+			with open(part_path, "wb") as f:
+				if size > 0:
+					os.posix_fallocate(f.fileno(), 0, size)
+		for offset in range(0, size, chunk_bytes):
+			if offset not in done[path]:
+				work.append((path, offset, min(chunk_bytes, size - offset)))
+
+	resumed_chunks = sum(len(offsets) for offsets in done.values())
+	if resumed_chunks:
+		LOGGER.info(f"Resuming an interrupted pull, {resumed_chunks} chunks had already arrived")
+
+	# biggest chunks first, so one slow big file doesn't end up last on its own
+	work.sort(key=lambda item: -item[2])
+
+	def write_checkpoint():
+		save_checkpoint(checkpoint_path, {path: {"size": size, "mtime": mtime, "done": sorted(done[path])} for path, size, mtime in files})
+
+	lock = threading.Lock()
+	last_saved = [time.time()]
+	def record_progress(path, offset):
+		with lock:
+			done[path].add(offset)
+			if checkpoint_path and time.time() - last_saved[0] > CHECKPOINT_INTERVAL_SEC:
+				write_checkpoint()
+				last_saved[0] = time.time()
+
+	local = threading.local()
+	sftp_sessions = []
+	def pull_chunk(item):
+		path, offset, length = item
+		if not hasattr(local, "sftp"):
+			local.sftp = ssh_client.open_sftp()
+			sftp_sessions.append(local.sftp)
+		requests = [(o, min(request_bytes, offset + length - o)) for o in range(offset, offset + length, request_bytes)]
+		with open(get_part_path(os.path.join(local_dir, path)), "r+b") as f:
+			destination = mmap.mmap(f.fileno(), length, offset=offset)
+		try:
+			with local.sftp.open(posixpath.join(remote_dir, path), "rb") as remote_file:
+				for (request_offset, request_length), data in zip(requests, remote_file.readv(requests)):
+					destination[request_offset - offset:request_offset - offset + len(data)] = data
+		finally:
+			destination.close()
+		record_progress(path, offset)
+		return length
+
+	completed = False
+	try:
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			for length in executor.map(pull_chunk, work):
+				result.bytes_received += length
+		completed = True
+	finally:
+		for sftp in sftp_sessions:
+			try:
+				sftp.close()
+			except (OSError, EOFError):
+				pass # the connection may already be gone, which is likely why we're here
+		if checkpoint_path and completed:
+			if os.path.exists(checkpoint_path):
+				os.remove(checkpoint_path)
+		elif checkpoint_path:
+			write_checkpoint()
+
+	for path, size, mtime in files:
+		local_path = os.path.join(local_dir, path)
+		os.utime(get_part_path(local_path), (mtime, mtime))
+		os.replace(get_part_path(local_path), local_path)
+
+	result.files_transferred = len(files)
+	result.elapsed_sec = time.time() - start_time
+	result.details = {"mode": "sftp", "workers": workers, "resumed_chunks": resumed_chunks}
+	LOGGER.info(f"Pulled {result.files_transferred} files ({result.bytes_received/1e6:.1f} MB) at {result.bytes_per_sec/1e6:.1f} MB/s")
+	return result
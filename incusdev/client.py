@@ -1,6 +1,7 @@
 """Client to handle connections and actions executed against a remote host."""
-import subprocess, sys, os, glob, traceback, time, tempfile, textwrap, shutil
-import threading, queue
+import subprocess, sys, os, glob, traceback, time, tempfile, textwrap, shutil, json, posixpath
+import threading, queue, shlex, uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from paramiko import RSAKey, SSHClient, SSHConfig, ProxyCommand, RejectPolicy
@@ -13,6 +14,8 @@ from paramiko.ssh_exception import (
 )
 
 from .log import LOGGER 
+from . import gitsync, compression, ignore, progress, artifacts, output_filters, shared_folder
+from .paths import remote_filename_from_local, local_filename_from_remote
 
 def ensure_container_is_on(container_name):
 	# turn on the doc-dev container if it is not already on
@@ -29,9 +32,70 @@ def ensure_container_is_on(container_name):
 			time.sleep(1)
 			LOGGER.info(f"{count-i}")
 
+def make_incus_rsh_file(incus_cmd="incus"):
+	"""
+	Make a temporary script that rsync can use in place of ssh (with -e),
+	so it talks to the container over 'incus exec' instead.
+	The file is deleted when the returned object is garbage collected.
+	"""
+	# 6jan2022
+	# tempfile technique from here https://stackoverflow.com/questions/28410137/python-create-temp-file-namedtemporaryfile-and-call-subprocess-on-it
+	fake_ssh_fp = tempfile.NamedTemporaryFile(delete=True)
+	with open(fake_ssh_fp.name, "w") as f:
+		f.write(textwrap.dedent(f"""
+			#!/bin/sh
+			ctn="${{1}}"
+			shift
+			exec {incus_cmd} exec "${{ctn}}" -- "$@"
+		""".lstrip("\n")))
+	os.chmod(fake_ssh_fp.name, 0x0777)
+	fake_ssh_fp.file.close()
+	return fake_ssh_fp
+
+# keepalives stop an idle session being dropped by NAT or firewalls, and make a dead transport show up as inactive
+KEEPALIVE_SEC = 15
+RECONNECT_ATTEMPTS = 5
+
+# how many submodules are synced at once by git_sync_submodules_to_container
+SUBMODULE_SYNC_WORKERS = 8
+
 class myRemoteException(Exception):
 	pass
 
+class CommandResult:
+	""" The outcome of one command from execute_batch. """
+
+	def __init__(self, command, stdout, stderr, exit_code, duration_sec):
+		self.command = command
+		self.stdout = stdout # as lists of lines, like execute_commands returns
+		self.stderr = stderr
+		self.exit_code = exit_code # None if it didn't run, because an earlier command failed with stop_on_failure
+		self.duration_sec = duration_sec
+
+	@property
+	def ok(self):
+		return self.exit_code == 0
+
+	def __repr__(self):
+		return f"CommandResult({self.command!r}, exit_code={self.exit_code}, {self.duration_sec:.3f}s)"
+
+# run by 'sh -s' in the container for execute_batch. Each command gets its own 'sh -c', and its
+# output is framed by a header line holding its exit code, duration and output lengths in bytes,
+# so any output (including the boundary string) can't be confused with the framing
+BATCH_SCRIPT_HEAD = textwrap.dedent("""
+	d=$(mktemp -d)
+	trap 'rm -rf "$d"' EXIT
+	run_one() {
+		start=$(date +%s%N)
+		sh -c "$2" </dev/null >"$d/out" 2>"$d/err"
+		rc=$?
+		end=$(date +%s%N)
+		printf '%s %s %s %s %s %s\\n' "$B" "$1" "$rc" "$((end - start))" "$(wc -c <"$d/out")" "$(wc -c <"$d/err")"
+		cat "$d/out" "$d/err"
+		return $rc
+	}
+""")
+
 
 class RemoteClient:
 	"""Client to interact with a remote host via SSH & SCP."""
@@ -43,6 +107,7 @@ class RemoteClient:
 		local_working_directory: str,
 		user = "ubuntu",
 		ssh_config_filepath="~/.ssh/config",
+		strip_ansi=False,
 	):
 		self.host = host
 		self.incus_container_name = incus_container_name
@@ -51,6 +116,17 @@ class RemoteClient:
 		self.user = user
 		self.ssh_config_filepath = ssh_config_filepath
 		self.client = None
+		self.shared_folder = None # the device sharing the working directory, "" if it isn't shared, or None if not looked up yet
+		self.reconnects = 0 # over the life of this client, as well as per sync in each SyncResult
+		self.resumes = 0
+		# syncs run on several threads at once, so the totals are added to under a lock, and each
+		# thread keeps its own counts too, so a sync's SyncResult only counts what happened in it
+		self.counts_lock = threading.Lock()
+		self.thread_counts = threading.local()
+		# pipeline steps share this client from several threads, only one of them should reconnect
+		self.reconnect_lock = threading.Lock()
+		# built once, so the regexes and path mapping aren't redone for every line of output
+		self.output_pipeline = output_filters.default_pipeline(strip_ansi=strip_ansi)
 		
 		
 
@@ -58,30 +134,7 @@ class RemoteClient:
 		"""Open SSH connection to remote host."""
 		try:
 			ensure_container_is_on(self.incus_container_name)
-
-
-			# 10, 11 dec 2021
-			# from https://gist.github.com/acdha/6064215
-			cfg = {'hostname': self.host, 'username': self.user}
-
-			self.client = SSHClient()
-			self.client.load_system_host_keys()
-			self.client._policy = RejectPolicy()
-			ssh_config = SSHConfig()
-			user_config_file = os.path.expanduser(self.ssh_config_filepath)
-			if os.path.exists(user_config_file):
-				with open(user_config_file) as f:
-					ssh_config.parse(f)
-			
-			user_config = ssh_config.lookup(cfg['hostname'])
-			for k in ('hostname', 'username', 'port'):
-				if k in user_config:
-					cfg[k] = user_config[k]
-
-			if 'proxycommand' in user_config:
-				cfg['sock'] = ProxyCommand(user_config['proxycommand'])
-
-			self.client.connect(**cfg)
+			self.connect()
 			return self
 
 		except AuthenticationException as e:
@@ -98,12 +151,91 @@ class RemoteClient:
 
 	def __exit__(self, exc_type, exc_value, traceback):
 		"""Close SSH connection"""
+		if self.reconnects or self.resumes:
+			LOGGER.info(f"Session with {self.host} needed {self.reconnects} reconnects and {self.resumes} resumed transfers")
 		self.client.close()
 
-	
+	def connect(self):
+		# 10, 11 dec 2021
+		# from https://gist.github.com/acdha/6064215
+		cfg = {'hostname': self.host, 'username': self.user}
+
+		self.client = SSHClient()
+		self.client.load_system_host_keys()
+		self.client._policy = RejectPolicy()
+		ssh_config = SSHConfig()
+		user_config_file = os.path.expanduser(self.ssh_config_filepath)
+		if os.path.exists(user_config_file):
+			with open(user_config_file) as f:
+				ssh_config.parse(f)
+		
+		user_config = ssh_config.lookup(cfg['hostname'])
+		for k in ('hostname', 'username', 'port'):
+			if k in user_config:
+				cfg[k] = user_config[k]
+
+		if 'proxycommand' in user_config:
+			cfg['sock'] = ProxyCommand(user_config['proxycommand'])
+
+		self.client.connect(**cfg)
+		self.client.get_transport().set_keepalive(KEEPALIVE_SEC)
+
+	def is_connected(self):
+		transport = self.client.get_transport() if self.client is not None else None
+		return transport is not None and transport.is_active()
+
+	def ensure_connected(self):
+		"""
+		Reconnect if the ssh transport has died, e.g. after the laptop was suspended or the
+		network changed, retrying with backoff. Commands that were running when it dropped
+		aren't restarted, as they'll have been hung up on in the container.
+		"""
+		if self.is_connected():
+			return
+		with self.reconnect_lock:
+			if not self.is_connected(): # another thread may have reconnected while this one waited
+				self.reconnect()
+
+	def add_count(self, name, n=1):
+		""" Add to one of the client's totals ("reconnects" or "resumes"), and to the calling thread's own count. """
+		with self.counts_lock:
+			setattr(self, name, getattr(self, name) + n)
+		setattr(self.thread_counts, name, self.thread_count(name) + n)
+
+	def thread_count(self, name):
+		return getattr(self.thread_counts, name, 0)
+
+	def reconnect(self):
+		for attempt in range(RECONNECT_ATTEMPTS):
+			if attempt > 0:
+				time.sleep(progress.backoff_sec(attempt - 1))
+			LOGGER.warning(f"Connection to {self.host} lost, reconnecting (attempt {attempt + 1} of {RECONNECT_ATTEMPTS})")
+			try:
+				self.client.close()
+				self.connect()
+				self.add_count("reconnects")
+				return
+			except (SSHException, EOFError, OSError) as e:
+				error = e
+		raise myRemoteException(f"Unable to reconnect to {self.host}: {error}")
+
+	def exec_command(self, command, **kwargs):
+		""" self.client.exec_command, but reconnecting first if the transport has died. """
+		self.ensure_connected()
+		try:
+			return self.client.exec_command(command, **kwargs)
+		except (SSHException, EOFError, OSError):
+			if self.is_connected():
+				raise
+			self.ensure_connected() # it died since the check, so try once more
+			return self.client.exec_command(command, **kwargs)
+
+	def open_sftp(self):
+		self.ensure_connected()
+		return self.client.open_sftp()
+
 	def get_remote_filename_from_local(self, local_filename, get_as_relative = False):
-		assert "home" in local_filename, f"content must be in the host user's home folder, which is currently: {local_filename}"
-		remote_filename = local_filename.replace("/home/", "/home/ubuntu/from_host/") # don't use ~ here as it makes it harder to match path strings
+		remote_filename = remote_filename_from_local(local_filename)
 
 		if get_as_relative:
 			remote_filename = os.path.relpath(remote_filename, self.remote_working_directory)
@@ -112,9 +244,7 @@ class RemoteClient:
 		return remote_filename
 	
 	def get_local_fileneme_from_remote(self, remote_filename):
-		assert remote_filename.startswith("/home/ubuntu/from_host"), f"remote_filename must start with /home/ubuntu/from_host"
-		local_filename = remote_filename.replace("/home/ubuntu/from_host/", "/home/")
-		return local_filename
+		return local_filename_from_remote(remote_filename)
 	
 	def rsync(self, delete = False, direction = "local_to_remote", rel_local_dir = "content", rel_remote_dir = "invalid_dir"):
 		# 10dec2021 from https://discuss.linuxcontainers.org/t/rsync-files-into-container-from-host/822
@@ -122,18 +252,10 @@ class RemoteClient:
 		# -avPz means --archive --verbose --partial --progress --compress"
 		# the extra --delete is so deleted files are removed
 
-		# 6jan2022
-		# tempfile technique from here https://stackoverflow.com/questions/28410137/python-create-temp-file-namedtemporaryfile-and-call-subprocess-on-it
-		fake_ssh_fp = tempfile.NamedTemporaryFile(delete=True)
-		with open(fake_ssh_fp.name, "w") as f:
-			f.write(textwrap.dedent("""
-				#!/bin/sh
-				ctn="${1}"
-				shift
-				exec incus exec "${ctn}" -- "$@"
-			""".lstrip("\n")))
-		os.chmod(fake_ssh_fp.name, 0x0777)
-		fake_ssh_fp.file.close()
+		fake_ssh_fp = make_incus_rsh_file()
+		compression_args, _ = compression.rsync_compression_args(self.incus_container_name, rel_local_dir,
+			remote_dir=f"/home/ubuntu/Documents/{rel_remote_dir}" if direction == "remote_to_local" else None)
+		compression_arg = "".join(" " + arg for arg in compression_args)
 
 		success = True
 		try:
@@ -142,11 +264,11 @@ class RemoteClient:
 				self.execute_commands(f"mkdir -p /home/ubuntu/Documents/Outputs") # make remote directory tree if it doesn't exist
 
 				log_str = f"Used rsync from local {rel_local_dir} to {self.host}:/home/ubuntu/Documents/{rel_remote_dir}"
-				cmd = f"rsync -avPz {rel_local_dir}/ -e {fake_ssh_fp.name} {self.incus_container_name}:/home/ubuntu/Documents/{rel_remote_dir}/{' --delete' if delete else ''}"
+				cmd = f"rsync -avP{compression_arg} {rel_local_dir}/ -e {fake_ssh_fp.name} {self.incus_container_name}:/home/ubuntu/Documents/{rel_remote_dir}/{' --delete' if delete else ''}"
 
 			elif direction == "remote_to_local":
 				log_str = f"Used rsync from {self.host}:/home/ubuntu/Documents/{rel_remote_dir} to local {rel_local_dir}"
-				cmd = f"rsync -avPz -e {fake_ssh_fp.name} {self.incus_container_name}:/home/ubuntu/Documents/{rel_remote_dir}/ {rel_local_dir}/{' --delete' if delete else ''}"
+				cmd = f"rsync -avP{compression_arg} -e {fake_ssh_fp.name} {self.incus_container_name}:/home/ubuntu/Documents/{rel_remote_dir}/ {rel_local_dir}/{' --delete' if delete else ''}"
 
 			LOGGER.opt(ansi=True).info(f"<green>{log_str}</green>")
 			
@@ -175,6 +297,7 @@ class RemoteClient:
 			# execute in remote working dir?
 			commands = [f"cd {self.remote_working_directory} && "] + commands
 
+		self.ensure_connected()
 		channel = self.client.invoke_shell()
 		stdin = channel.makefile('wb')
 		stdout = channel.makefile('r')
@@ -229,34 +352,6 @@ class RemoteClient:
 		:type commands: List[str]
 		"""
 
-		def print_local_traceback_file_references(src_array):
-			""" 
-			This prints out an extra line containing a path to the referenced file on the host machine,
-			so in vscode you can just click it and be taken to the referred file.
-			This does make assumptions about where the file is (in /home/ubuntu/from_host/... in the container).
-			"""
-			# print(os.getcwd()) # /home/x/Documents/git_repos/gateware/amaram
-			# print(os.path.expanduser("~"))# /home/x
-			# 02-10-2022 14:52:14 | ERROR:   File "/home/ubuntu/from_host/x/Documents/git_repos/gateware/amaram/tests/ulx3s_gui_test/fpga_gateware/fpga_io_sim.py", line 28, in <module>
-
-			if src_array != type([]):
-				src_array = [src_array]
-
-			dst_array = []
-			common_project_dir = os.getcwd().replace(os.path.expanduser("~"), "") # so should be "/Documents/git_repos/gateware/amaram"
-			for each_line in src_array:
-				if common_project_dir in each_line:
-					dst_array.append(each_line)
-
-					line_with_local_reference = "." + each_line.split(common_project_dir)[-1]
-					dst_array.append(f"(Local file reference: {line_with_local_reference})")
-
-				else:
-					dst_array.append(each_line)
-
-			return dst_array
-
-
 		if type(commands) == str:
 			combined_cmd = commands
 		elif type(commands) == list:
@@ -275,12 +370,16 @@ class RemoteClient:
 
 		LOGGER.opt(ansi=True).info(f"<green>{self.user}@{self.host} $ {combined_cmd}</green>")
 
-		stdin, stdout, stderr = self.client.exec_command(combined_cmd, **kwargs)
+		stdin, stdout, stderr = self.exec_command(combined_cmd, **kwargs)
 
 		if pass_to_stdin != None:
 			stdin.channel.send(pass_to_stdin)
 			stdin.channel.shutdown_write()			
 
+		pipeline = self.output_pipeline
+		if not add_local_traceback_file_references:
+			pipeline = pipeline.without(output_filters.PathRewriteFilter)
+
 		result_lines = []
 		# stdout.channel.recv_exit_status()  # not used? 28jan2022
 		try:
@@ -290,7 +389,8 @@ class RemoteClient:
 					break			
 				line = line.strip("\n")
 				LOGGER.trace(f"INPUT: {combined_cmd}")
-				LOGGER.info(f"{line}")
+				for record in pipeline.process(line, "stdout"):
+					LOGGER.log(record.level, record.text)
 				result_lines.append(line)
 		except Exception as e:
 			print(e)
@@ -305,27 +405,18 @@ class RemoteClient:
 			if not error_line:
 				break
 			error_line = error_line.strip("\n")
-			if ("WARNING" in error_line):
-				pass # don't fail on warnings?
-				LOGGER.info(f"{error_line}")
-			else:
-				success = False
-				# LOGGER.error(f"{error_line}")
-
-				def log_error_line(error_line):
-					try:
-						LOGGER.opt(ansi=True).error(f"{error_line}") # for colours printed on stderr
-					except:
-						LOGGER.error(f"{error_line}")
-
-				if add_local_traceback_file_references:
-					for err_line in print_local_traceback_file_references(error_line):
-						log_error_line(err_line)
-				else:
-					log_error_line(error_line)
+			for record in pipeline.process(error_line, "stderr"):
+				if record.level == "ERROR":
+					success = False # warnings and harmless lines on stderr don't count as failing
+				LOGGER.log(record.level, record.text)
 
 			error_lines.append(error_line)
 
+		if not self.is_connected():
+			# the output just stops when the connection drops, so it'd otherwise look like the command finished
+			success = False
+			LOGGER.error(f"Connection to {self.host} was lost while running: {combined_cmd}")
+
 		if (not ignore_failures) and (not success):
 			# raise myRemoteException(error_lines)
 			pass
@@ -336,6 +427,68 @@ class RemoteClient:
 		else:
 			return result_lines
 	
+	def execute_batch(self, commands, within_remote_working_dir=False, stop_on_failure=False, raise_on_failure=False):
+		"""
+		Run several independent commands in the container in a single round trip,
+		getting each one's stdout, stderr, exit code and duration back separately.
+
+		Unlike execute_commands, the commands aren't joined with &&, so each one runs
+		(in its own shell, so a 'cd' won't carry over) even if an earlier one failed,
+		unless stop_on_failure is set.
+
+		:param commands: List of unix commands as strings.
+		:returns: List of CommandResult, one per command.
+		"""
+		assert type(commands) == list, "execute_batch takes a list of commands"
+
+		boundary = "incusdev-batch-" + uuid.uuid4().hex
+		script = BATCH_SCRIPT_HEAD + f"B={boundary}\n"
+		for i, cmd in enumerate(commands):
+			if within_remote_working_dir:
+				cmd = f"cd {self.remote_working_directory} && " + cmd
+			script += f"run_one {i} {shlex.quote(cmd)}" + (" || exit 0\n" if stop_on_failure else "\n")
+			LOGGER.opt(ansi=True).info(f"<green>{self.user}@{self.host} $ {cmd}</green>")
+
+		stdin, stdout, stderr = self.exec_command("sh -s")
+		stdin.channel.sendall(script.encode("utf-8"))
+		stdin.channel.shutdown_write()
+		raw = stdout.read()
+		script_errors = stderr.read().decode("utf-8", errors="replace").strip()
+		if script_errors:
+			LOGGER.error(f"execute_batch: {script_errors}")
+
+		results = [CommandResult(cmd, [], [], None, 0.0) for cmd in commands]
+		header_prefix = (boundary + " ").encode("utf-8")
+		pos = 0
+		while raw.startswith(header_prefix, pos):
+			header_end = raw.index(b"\n", pos)
+			_, i, rc, duration_ns, out_len, err_len = raw[pos:header_end].decode("utf-8").split()
+			out_start = header_end + 1
+			err_start = out_start + int(out_len)
+			pos = err_start + int(err_len)
+
+			result = results[int(i)]
+			result.stdout = raw[out_start:err_start].decode("utf-8", errors="replace").splitlines()
+			result.stderr = raw[err_start:pos].decode("utf-8", errors="replace").splitlines()
+			result.exit_code = int(rc)
+			result.duration_sec = int(duration_ns) / 1e9
+
+		for result in results:
+			for line in result.stdout:
+				for record in self.output_pipeline.process(line, "stdout"):
+					LOGGER.log(record.level, record.text)
+			for line in result.stderr:
+				# stderr from a command that succeeded is treated like stdout, e.g. progress messages
+				for record in self.output_pipeline.process(line, "stdout" if result.ok else "stderr"):
+					LOGGER.log(record.level, record.text)
+			if result.exit_code not in [0, None]:
+				LOGGER.error(f"exit code {result.exit_code} from: {result.command}")
+
+		failures = [r for r in results if r.exit_code not in [0, None]]
+		if raise_on_failure and failures:
+			raise myRemoteException(failures)
+		return results
+
 	def clean(self): # obsolete
 		folders_to_delete =  ["Outputs", "Uploads"]
 		for folder in folders_to_delete:
@@ -362,7 +515,7 @@ class RemoteClient:
 					self.execute_commands(f"rm -r {path}/*")
 
 
-	def rsync_abs(self, delete = False, direction = "local_to_remote", abs_local_dir = "content", abs_remote_dir = "invalid_dir"):
+	def rsync_abs(self, delete = False, direction = "local_to_remote", abs_local_dir = "content", abs_remote_dir = "invalid_dir", files_from = None, use_ignore_rules = True, on_progress = None, exclude_paths = None):
 		# 26jan2022
 		# changed to use abs paths
 		# next: phase out the old rsync and replace it with this
@@ -372,20 +525,38 @@ class RemoteClient:
 		# -avPz means --archive --verbose --partial --progress --compress"
 		# the extra --delete is so deleted files are removed
 
-		# 6jan2022
-		# tempfile technique from here https://stackoverflow.com/questions/28410137/python-create-temp-file-namedtemporaryfile-and-call-subprocess-on-it
-		fake_ssh_fp = tempfile.NamedTemporaryFile(delete=True)
-		with open(fake_ssh_fp.name, "w") as f:
-			f.write(textwrap.dedent("""
-				#!/bin/sh
-				ctn="${1}"
-				shift
-				exec incus exec "${ctn}" -- "$@"
-			""".lstrip("\n")))
-		os.chmod(fake_ssh_fp.name, 0x0777)
-		fake_ssh_fp.file.close()
+		fake_ssh_fp = make_incus_rsh_file()
+
+		# optionally only transfer the given relative paths, rather than walking the whole tree
+		files_from_arg = ""
+		if files_from is not None:
+			files_from_fp = tempfile.NamedTemporaryFile(delete=True)
+			files_from_fp.write(b"\0".join(p.encode("utf-8", errors="surrogateescape") for p in files_from) + b"\0")
+			files_from_fp.flush()
+			files_from_arg = f" --from0 --files-from={files_from_fp.name}"
+
+		# skip whatever .gitignore/.incusdevignore rules exclude, in both directions,
+		# so --delete also leaves the excluded paths on the receiving side alone.
+		# not needed with files_from, as that list has already been chosen
+		ignore_stats = None
+		if use_ignore_rules and files_from is None:
+			exclude_fp, ignore_stats = ignore.make_rsync_exclude_file(abs_local_dir, skip_paths=exclude_paths or ())
+			files_from_arg += f" --exclude-from={exclude_fp.name}"
+
+		# directories (relative to abs_local_dir) that something else syncs, e.g. submodules.
+		# being excluded also stops --delete from touching them
+		if exclude_paths:
+			exclude_paths_fp = tempfile.NamedTemporaryFile(mode="w", delete=True)
+			exclude_paths_fp.write("".join(f"/{path}/\n" for path in exclude_paths))
+			exclude_paths_fp.flush()
+			files_from_arg += f" --exclude-from={exclude_paths_fp.name}"
+
+		# only compress when it's expected to make the transfer faster
+		# for pulls, sample what's in the container, as the local copy is what's about to be replaced
+		compression_args, compression_decision = compression.rsync_compression_args(self.incus_container_name, abs_local_dir, files_from,
+			remote_dir=abs_remote_dir.replace("~", "/home/ubuntu") if direction == "remote_to_local" else None)
+		files_from_arg += "".join(" " + arg for arg in compression_args)
 
-		success = True
 		try:
 			# assuming this will always be used with incus with an ubuntu user,
 			abs_remote_dir = abs_remote_dir.replace("~", "/home/ubuntu")
@@ -395,27 +566,23 @@ class RemoteClient:
 				# self.execute_commands(f"mkdir -p /home/ubuntu/Documents/Outputs") # make remote directory tree if it doesn't exist
 
 				log_str = f"Used rsync from local {abs_local_dir} to {self.host}:{abs_remote_dir}"
-				cmd = f"rsync -avz {abs_local_dir}/ -e {fake_ssh_fp.name} {self.incus_container_name}:{abs_remote_dir}/{' --delete' if delete else ''}"
+				cmd = f"rsync -av{files_from_arg} {abs_local_dir}/ -e {fake_ssh_fp.name} {self.incus_container_name}:{abs_remote_dir}/{' --delete' if delete else ''}"
 
 			elif direction == "remote_to_local":
 				log_str = f"Used rsync from {self.host}:{abs_remote_dir} to local {abs_local_dir}"
-				cmd = f"rsync -avz -e {fake_ssh_fp.name} {self.incus_container_name}:{abs_remote_dir}/ {abs_local_dir}/{' --delete' if delete else ''}"
+				cmd = f"rsync -av{files_from_arg} -e {fake_ssh_fp.name} {self.incus_container_name}:{abs_remote_dir}/ {abs_local_dir}/{' --delete' if delete else ''}"
 
 			# LOGGER.opt(ansi=True).info(f"<green>{log_str}</green>")
-			
-			for response_line in subprocess.check_output(cmd.split(" ")).decode("utf-8").split("\n"):
-				response_line = response_line.replace("\r", "") # so things stay on one line
-				# print(response_line.encode("utf-8"))
-				if any(x in response_line for x in ["rsync error", "failed"]):
-					success = False
-					LOGGER.error(f"rsync failed: {response_line}")
-				else:
-					LOGGER.opt(ansi=True).info(f"<light-blue>{response_line}</light-blue>")
 
-			assert success, "Aborting after rsync failure"
-				
-		except FileNotFoundError as error:
-			LOGGER.error(error)
+			# output is streamed as rsync runs, and failures come from its exit code
+			result = progress.run_rsync_resumable(cmd.split(" "), on_progress)
+			self.add_count("resumes", result.resumes)
+			result.details.update({"compression": compression_decision, "ignored": ignore_stats})
+			LOGGER.info(f"{result}, at {result.bytes_per_sec/1e6:.2f} MB/s")
+			return result
+
+		except FileNotFoundError as e:
+			LOGGER.error(e)
 			raise e
 
 		except Exception as e:
@@ -425,9 +592,43 @@ class RemoteClient:
 		finally:
 			LOGGER.opt(ansi=True).info(f"<green>{log_str}</green>")
 
-	def rsync_to_container(self, delete=True):
+	def uses_shared_folder(self):
+		""" True if the working directory is mounted in the container (see 'attach_shared_folder'), so syncing isn't needed. """
+		if self.shared_folder is None:
+			try:
+				self.shared_folder = shared_folder.find_shared_folder(self.incus_container_name, self.local_working_directory) or ""
+			except (RuntimeError, OSError, ValueError, KeyError) as e:
+				LOGGER.warning(f"Couldn't check {self.incus_container_name} for a shared folder, assuming there isn't one: {e}")
+				self.shared_folder = ""
+		return self.shared_folder != ""
+
+	def attach_shared_folder(self):
+		"""
+		Mount the local working directory in the container at remote_working_directory, as an
+		incus disk device with uid shifting, instead of copying it there. File names map the
+		same way as with rsync, and while it's attached the sync methods do nothing.
+		Safe to call when it's already attached.
+		"""
+		self.shared_folder = shared_folder.attach(self.incus_container_name, self.local_working_directory)
+
+	def detach_shared_folder(self):
+		""" Undo 'attach_shared_folder', going back to rsync. Safe to call when it isn't attached. """
+		shared_folder.detach(self.incus_container_name, self.local_working_directory)
+		self.shared_folder = None
+
+	def shared_folder_sync_result(self):
+		""" An empty SyncResult if the working directory is a shared folder, so there's nothing to sync, otherwise None. """
+		if not self.uses_shared_folder():
+			return None
+		LOGGER.info(f"{self.local_working_directory} is shared with {self.incus_container_name} (device {self.shared_folder}), nothing to sync")
+		result = progress.SyncResult()
+		result.details = {"mode": "shared_folder", "device": self.shared_folder}
+		return result
+
+	def rsync_to_container(self, delete=True, on_progress=None):
 		""" 
-		An alternative to using a shared folder approach.
+		An alternative to using a shared folder approach (see 'attach_shared_folder').
+		If the working directory is already shared with the container, this does nothing.
 		For a self.local_working_directory of 
 			~/Documents/git_repos/a/b/c
 		rsync the given directory to the container in the dir
@@ -435,31 +636,219 @@ class RemoteClient:
 
 		Delete defeults to true, so the remote container always closely
 		mirrors the local working directory.
+
+		on_progress is called with a dict of overall progress as the transfer
+		runs, and a SyncResult is returned once it's done.
 		"""
 
-		self.rsync_abs(
+		shared = self.shared_folder_sync_result()
+		if shared is not None:
+			return shared
+		# todo - print the difference between remote and local dirs?
+		return self.rsync_abs(
 			delete = delete,
 			direction = "local_to_remote",
 			abs_local_dir=self.local_working_directory,
-			abs_remote_dir=self.remote_working_directory
+			abs_remote_dir=self.remote_working_directory,
+			on_progress=on_progress
 		)
 
-		# todo - print the difference between remote and local dirs?
-
-	def rsync_from_container(self, delete=True):
+	def rsync_from_container(self, delete=True, on_progress=None):
 		""" 
 		The opposite of 'rsync_to_container'
 
 		Delete defeults to true, so the local working directory always
 		shows an accurate representation of the remote working directory.
 		"""
-		self.rsync_abs(
+		shared = self.shared_folder_sync_result()
+		if shared is not None:
+			return shared
+		return self.rsync_abs(
 			delete = delete,
 			direction = "remote_to_local",
 			abs_local_dir=self.local_working_directory,
-			abs_remote_dir=self.remote_working_directory
+			abs_remote_dir=self.remote_working_directory,
+			on_progress=on_progress
 		)
 		
 
 
 		
+
+
+	def git_sync_to_container(self, delete=True, on_progress=None):
+		"""
+		Like 'rsync_to_container', but for git working trees, using git's index
+		rather than a full tree walk to find what changed since the last sync.
+
+		The container keeps a small manifest of what it was last given (the HEAD
+		commit, plus the object ids of files that differed from it). Git then
+		reports which paths could have changed, their object ids are compared
+		against the manifest, and only the ones that differ are transferred.
+		Untracked files are included unless they are ignored.
+
+		Falls back to a full rsync if there's no usable manifest yet. The .git
+		directory itself is only re-synced when HEAD moves.
+
+		A tree with checked out submodules is synced as 'git_sync_submodules_to_container'
+		does, as edits inside a submodule don't show up in the superproject's index.
+		"""
+		shared = self.shared_folder_sync_result()
+		if shared is not None:
+			return shared
+		git_root = gitsync.get_git_root(self.local_working_directory)
+		if gitsync.list_submodules(git_root):
+			LOGGER.info(f"{git_root} has submodules, syncing each as its own working tree")
+			return self.git_sync_submodules_to_container(delete=delete, on_progress=on_progress)
+		return self.git_sync_tree(git_root, delete=delete, on_progress=on_progress)
+
+	def git_sync_submodules_to_container(self, delete=True, on_progress=None, workers=SUBMODULE_SYNC_WORKERS):
+		"""
+		Like 'git_sync_to_container', but the superproject and each of its submodules
+		(found from the gitlinks in each index, recursively) are synced as separate working
+		trees, several at once, each with its own manifest. Those whose commit and working
+		tree match what the container was last given are skipped without any transfer,
+		so a sync takes about as long as the largest changed submodule.
+		"""
+		shared = self.shared_folder_sync_result()
+		if shared is not None:
+			return shared
+		start_time = time.time()
+		top_root = gitsync.get_git_root(self.local_working_directory)
+		units = gitsync.discover_sync_units(top_root)
+		LOGGER.info(f"Syncing {len(units)} git working trees under {top_root}, {workers} at a time")
+
+		if os.environ.get("INCUSDEV_COMPRESSION", "auto") not in compression.POLICIES:
+			compression.get_link_speed(self.incus_container_name) # measured once up front, rather than by every sync at once
+
+		def sync_unit(unit):
+			git_root, submodule_paths = unit
+			return self.git_sync_tree(git_root, delete=delete, on_progress=on_progress, exclude_paths=submodule_paths)
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			unit_results = list(executor.map(sync_unit, units))
+
+		result = progress.SyncResult()
+		for unit_result in unit_results:
+			result.add(unit_result)
+		result.elapsed_sec = time.time() - start_time # the syncs overlap, so their times don't add up
+		result.details = {
+			"mode": "git_submodules",
+			"units": len(units),
+			"skipped": sum(1 for r in unit_results if r.details.get("skipped")),
+			"per_unit": {os.path.relpath(git_root, top_root): {
+				"skipped": r.details.get("skipped", False),
+				"files_transferred": r.files_transferred,
+				"elapsed_sec": r.elapsed_sec,
+			} for (git_root, _), r in zip(units, unit_results)},
+		}
+		LOGGER.info(f"git submodule sync: {result}, {result.details['skipped']} of {len(units)} unchanged")
+		return result
+
+	def git_sync_tree(self, git_root, delete=True, on_progress=None, exclude_paths=()):
+		"""
+		The work of 'git_sync_to_container' for one git working tree, leaving out the given
+		submodule paths (relative to git_root), which are expected to be synced separately.
+		"""
+		start_time = time.time()
+		reconnects_before = self.thread_count("reconnects")
+		remote_git_root = self.get_remote_filename_from_local(git_root)
+		manifest_path = gitsync.get_manifest_path(remote_git_root, self.user)
+
+		old_manifest = self.read_remote_json(manifest_path)
+		to_send, to_delete, new_manifest, candidate_count = gitsync.compute_changes(git_root, old_manifest, ignore_submodules=bool(exclude_paths))
+
+		result = progress.SyncResult()
+		result.details = {"mode": "git", "head": new_manifest["head"], "full_sync": to_send is None, "candidates": candidate_count, "skipped": False}
+
+		if to_send is not None and old_manifest == new_manifest:
+			LOGGER.info(f"{git_root} is unchanged since it was last synced, skipping")
+			result.details["skipped"] = True
+			result.elapsed_sec = time.time() - start_time
+			return result
+
+		# a submodule's repository lives elsewhere (under the superproject's .git/modules), and that's left
+		# out of the superproject's own syncs when its submodules are being synced separately
+		git_dir = gitsync.get_git_dir(git_root)
+		git_dir_inside = git_dir == os.path.join(git_root, ".git")
+		git_dir_excludes = ["modules"] if exclude_paths else None
+
+		if to_send is None:
+			LOGGER.info(f"No usable git sync manifest for {git_root} in {self.incus_container_name}, doing a full sync")
+			tree_excludes = list(exclude_paths) + ([".git/modules"] if exclude_paths and git_dir_inside else [])
+			result.add(self.rsync_abs(delete=delete, direction="local_to_remote", abs_local_dir=git_root, abs_remote_dir=remote_git_root, on_progress=on_progress, exclude_paths=tree_excludes))
+			if not git_dir_inside:
+				result.add(self.rsync_abs(delete=True, direction="local_to_remote", abs_local_dir=git_dir, abs_remote_dir=self.get_remote_filename_from_local(git_dir), use_ignore_rules=False, on_progress=on_progress, exclude_paths=git_dir_excludes))
+		else:
+			if old_manifest["head"] != new_manifest["head"]:
+				result.add(self.rsync_abs(delete=True, direction="local_to_remote", abs_local_dir=git_dir, abs_remote_dir=self.get_remote_filename_from_local(git_dir), use_ignore_rules=False, on_progress=on_progress, exclude_paths=git_dir_excludes))
+
+			if to_send:
+				result.add(self.rsync_abs(delete=False, direction="local_to_remote", abs_local_dir=git_root, abs_remote_dir=remote_git_root, files_from=to_send, on_progress=on_progress))
+			if to_delete and delete:
+				# paths are passed over stdin, NUL separated, so odd filenames are safe
+				self.execute_commands(f"cd {remote_git_root} && xargs -0 -r rm -f --", pass_to_stdin="\0".join(to_delete))
+				result.files_deleted += len(to_delete)
+
+		self.write_remote_json(manifest_path, new_manifest)
+		result.reconnects = self.thread_count("reconnects") - reconnects_before
+		result.elapsed_sec = time.time() - start_time
+		LOGGER.info(f"git sync: {result}")
+		return result
+
+	def pull_artifacts(self, patterns, workers=artifacts.WORKERS):
+		"""
+		Copy just the files matching the given glob patterns (relative to the remote working
+		directory, e.g. "Outputs/**/*.bit") back into the local working directory, rather than
+		mirroring the whole directory like 'rsync_from_container'. Nothing local is deleted.
+
+		The globs are expanded in the container in one call, then the files are downloaded
+		over sftp on the existing ssh connection, with several reads in flight at once.
+		If the connection drops part way, it's re-established and the pull carries on from
+		its checkpoint, so chunks that already arrived aren't fetched again.
+		Returns a SyncResult.
+		"""
+		shared = self.shared_folder_sync_result()
+		if shared is not None:
+			return shared
+		checkpoint_path = artifacts.get_checkpoint_path(self.remote_working_directory, self.local_working_directory)
+		reconnects_before = self.thread_count("reconnects")
+		resumes = 0
+		while True:
+			try:
+				files = artifacts.resolve_remote_globs(self, self.remote_working_directory, patterns)
+				if not files:
+					LOGGER.warning(f"No files in {self.remote_working_directory} matched {patterns}")
+				result = artifacts.pull_files(self.client, self.remote_working_directory, self.local_working_directory, files, workers=workers, checkpoint_path=checkpoint_path)
+				break
+			except (SSHException, EOFError, OSError) as e:
+				if self.is_connected() or resumes == RECONNECT_ATTEMPTS:
+					raise # not a dropped connection, or it keeps dropping
+				LOGGER.warning(f"Connection lost while pulling artifacts ({e}), resuming")
+				self.ensure_connected()
+				resumes += 1
+
+		self.add_count("resumes", resumes)
+		result.resumes = resumes
+		result.reconnects = self.thread_count("reconnects") - reconnects_before
+		return result
+
+	def read_remote_json(self, remote_path):
+		""" Read a json file from the container, or return None if it doesn't exist or can't be parsed. """
+		sftp = self.open_sftp()
+		try:
+			with sftp.open(remote_path, "r") as f:
+				return json.loads(f.read().decode("utf-8"))
+		except (IOError, ValueError):
+			return None
+		finally:
+			sftp.close()
+
+	def write_remote_json(self, remote_path, content):
+		self.execute_commands(f"mkdir -p {posixpath.dirname(remote_path)}")
+		sftp = self.open_sftp()
+		try:
+			with sftp.open(remote_path, "w") as f:
+				f.write(json.dumps(content).encode("utf-8"))
+		finally:
+			sftp.close()
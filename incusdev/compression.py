@@ -0,0 +1,198 @@
+"""Choose whether, and how hard, to compress a transfer, from the link speed and how compressible the data is."""
+import os, re, json, time, zlib, shlex, subprocess
+
+from .log import LOGGER
+
+# rsync compression settings for each policy.
+# the codec is pinned to zlib, which is what the sampling measures, as a bare -z
+# on rsync 3.2+ negotiates zstd first, where the levels mean something else
+POLICIES = {
+	"none": [],
+	"fast": ["-z", "--compress-choice=zlib", "--compress-level=1"],
+	"strong": ["-z", "--compress-choice=zlib", "--compress-level=9"],
+}
+
+LINK_CACHE_PATH = os.path.expanduser("~/.cache/incusdev/link_speed.json")
+LINK_CACHE_MAX_AGE_SEC = 7*24*60*60
+LINK_BENCHMARK_BYTES = 8*1024*1024
+
+SAMPLE_FILE_COUNT = 8 # the largest few files found are sampled, as they dominate the bytes sent
+SAMPLE_WALK_LIMIT = 500 # stop looking for files to sample after this many
+SAMPLE_CHUNK_BYTES = 64*1024
+REMOTE_SAMPLE_CHUNK_BYTES = 16*1024
+
+# if even the fast codec can't get data below this fraction of its size, don't bother
+INCOMPRESSIBLE_RATIO = 0.9
+
+def load_link_cache():
+	try:
+		with open(LINK_CACHE_PATH) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+def benchmark_link(incus_container_name, incus_cmd="incus"):
+	"""
+	Measure the bytes/sec of the incus exec pipe that rsync runs over, by pushing
+	incompressible data through it. The time taken for an empty push is subtracted,
+	so the exec startup cost isn't counted as link time.
+	"""
+	def timed_push(payload):
+		start = time.perf_counter()
+		subprocess.run(shlex.split(incus_cmd) + ["exec", incus_container_name, "--", "sh", "-c", "cat > /dev/null"],
+			input=payload, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+		return time.perf_counter() - start
+
+	latency = timed_push(b"")
+	elapsed = timed_push(os.urandom(LINK_BENCHMARK_BYTES))
+	return LINK_BENCHMARK_BYTES / max(elapsed - latency, 1e-6)
+
+def get_link_speed(incus_container_name, incus_cmd="incus", cache_key=None):
+	"""
+	Bytes/sec to the container, benchmarked on first use and then cached for a while.
+	cache_key lets short lived containers (e.g. pool clones) share one measurement.
+	"""
+	cache_key = cache_key or incus_container_name
+	cache = load_link_cache()
+	entry = cache.get(cache_key)
+	if entry is not None and time.time() - entry["measured"] < LINK_CACHE_MAX_AGE_SEC:
+		return entry["bytes_per_sec"]
+
+	bytes_per_sec = benchmark_link(incus_container_name, incus_cmd)
+	LOGGER.info(f"Measured link to {incus_container_name} at {bytes_per_sec/1e6:.1f} MB/s")
+
+	cache[cache_key] = {"bytes_per_sec": bytes_per_sec, "measured": time.time()}
+	os.makedirs(os.path.dirname(LINK_CACHE_PATH), exist_ok=True)
+	with open(LINK_CACHE_PATH, "w") as f:
+		json.dump(cache, f)
+	return bytes_per_sec
+
+def find_sample_files(local_dir, files=None):
+	""" The largest few files out of the batch, or out of the first part of a walk of local_dir. """
+	candidates = []
+	if files is not None:
+		paths = (os.path.join(local_dir, f) for f in files)
+	else:
+		def walk():
+			for root, dirs, filenames in os.walk(local_dir):
+				dirs[:] = [d for d in dirs if d != ".git"]
+				for filename in filenames:
+					yield os.path.join(root, filename)
+		paths = walk()
+
+	for i, path in enumerate(paths):
+		if i >= SAMPLE_WALK_LIMIT:
+			break
+		try:
+			if os.path.isfile(path) and not os.path.islink(path):
+				candidates.append((os.path.getsize(path), path))
+		except OSError:
+			pass
+	return [path for _, path in sorted(candidates, reverse=True)[:SAMPLE_FILE_COUNT]]
+
+def sample_compressibility(paths):
+	"""
+	Compress a chunk from the middle of each file at both levels, returning
+	{level: (compressed/original ratio, compression bytes/sec)}, or None if there was nothing to sample.
+	"""
+	sample = b""
+	for path in paths:
+		try:
+			with open(path, "rb") as f:
+				f.seek(max(os.path.getsize(path)//2 - SAMPLE_CHUNK_BYTES//2, 0)) # file headers tend to be unrepresentative
+				sample += f.read(SAMPLE_CHUNK_BYTES)
+		except OSError:
+			pass
+	return measure_compressibility(sample)
+
+def read_remote_sample(incus_container_name, remote_dir, incus_cmd="incus"):
+	"""
+	The same kind of sample, but taken in the container, for transfers coming out of it,
+	where the local copy may be stale or missing. Chunks are smaller than for local samples,
+	as they have to come over the link being measured.
+	"""
+	chunk = REMOTE_SAMPLE_CHUNK_BYTES
+	script = (f"cd {shlex.quote(remote_dir)} 2>/dev/null || exit 0; "
+		f"find . -path ./.git -prune -o -type f -printf '%s %p\\n' 2>/dev/null | head -n {SAMPLE_WALK_LIMIT} | sort -rn | head -n {SAMPLE_FILE_COUNT} | "
+		f"while read -r size path; do "
+		f"skip=$((size / 2 - {chunk // 2})); [ $skip -lt 0 ] && skip=0; "
+		f"tail -c +$((skip + 1)) \"$path\" | head -c {chunk}; done")
+	result = subprocess.run(shlex.split(incus_cmd) + ["exec", incus_container_name, "--", "sh", "-c", script],
+		stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	return result.stdout if result.returncode == 0 else b""
+
+def measure_compressibility(sample):
+	""" The measurement for sample_compressibility, on bytes that have already been read. """
+	if not sample:
+		return None
+
+	results = {}
+	for level in [1, 9]:
+		start = time.perf_counter()
+		compressed = zlib.compress(sample, level)
+		elapsed = max(time.perf_counter() - start, 1e-6)
+		results[level] = (len(compressed) / len(sample), len(sample) / elapsed)
+	return results
+
+def choose_policy(link_bytes_per_sec, compressibility):
+	"""
+	Pick the policy with the lowest estimated seconds per byte of input.
+	Compression and sending are pipelined, so whichever is slower sets the pace.
+	"""
+	if compressibility is None:
+		return "none"
+	fast_ratio, fast_speed = compressibility[1]
+	strong_ratio, strong_speed = compressibility[9]
+	if fast_ratio > INCOMPRESSIBLE_RATIO:
+		return "none"
+
+	cost = {
+		"none": 1 / link_bytes_per_sec,
+		"fast": max(1 / fast_speed, fast_ratio / link_bytes_per_sec),
+		"strong": max(1 / strong_speed, strong_ratio / link_bytes_per_sec),
+	}
+	return min(cost, key=cost.get)
+
+rsync_version = [] # filled in by get_rsync_version
+
+def get_rsync_version():
+	""" The local rsync's (major, minor) version, or (0, 0) if it can't be told. Looked up once per process. """
+	if not rsync_version:
+		try:
+			match = re.search(rb"version (\d+)\.(\d+)", subprocess.run(["rsync", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout)
+		except OSError:
+			match = None
+		rsync_version.append((int(match.group(1)), int(match.group(2))) if match else (0, 0))
+	return rsync_version[0]
+
+def policy_args(policy):
+	""" The rsync args for a policy. rsync before 3.2 only has zlib, and doesn't know --compress-choice. """
+	if get_rsync_version() < (3, 2):
+		return [arg for arg in POLICIES[policy] if not arg.startswith("--compress-choice")]
+	return POLICIES[policy]
+
+def rsync_compression_args(incus_container_name, local_dir, files=None, incus_cmd="incus", cache_key=None, remote_dir=None):
+	"""
+	Decide on compression for one rsync batch.
+	For transfers out of the container, give remote_dir, so the data is sampled where it's coming from.
+	Returns (extra rsync args, decision dict for the sync stats).
+	Set INCUSDEV_COMPRESSION to none, fast or strong to skip the measurements and force a policy.
+	"""
+	forced = os.environ.get("INCUSDEV_COMPRESSION", "auto")
+	if forced in POLICIES:
+		return policy_args(forced), {"policy": forced, "forced": True}
+
+	link_bytes_per_sec = get_link_speed(incus_container_name, incus_cmd, cache_key)
+	if remote_dir is not None:
+		compressibility = measure_compressibility(read_remote_sample(incus_container_name, remote_dir, incus_cmd))
+	else:
+		compressibility = sample_compressibility(find_sample_files(local_dir, files))
+	policy = choose_policy(link_bytes_per_sec, compressibility)
+
+	decision = {
+		"policy": policy,
+		"forced": False,
+		"link_bytes_per_sec": link_bytes_per_sec,
+		"sampled_ratio": compressibility[1][0] if compressibility is not None else None,
+	}
+	return policy_args(policy), decision
@@ -0,0 +1,211 @@
+"""Git-index-accelerated change detection, for syncing git working trees to a container."""
+import os, hashlib, subprocess, posixpath
+
+# the container keeps one small manifest per synced git working tree, describing
+# what it was last given: the commit it matches, plus the paths that differed from
+# that commit (and their git mode and object id, e.g. "100755 <oid>", or None if they were deleted)
+MANIFEST_VERSION = 2
+
+# how many paths to look up per 'git ls-tree', to keep well under the argument length limit
+LS_TREE_BATCH = 1000
+
+def run_git(git_root, args, stdin=None):
+	""" Run a git command in git_root and return its raw stdout, raising on failure. """
+	result = subprocess.run(["git", "-C", git_root] + args, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if result.returncode != 0:
+		raise RuntimeError(f"git {' '.join(args)} failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+	return result.stdout
+
+def split_z(raw):
+	""" Split NUL terminated git output (from -z) into a list of strings. """
+	return [x for x in raw.decode("utf-8", errors="surrogateescape").split("\0") if x != ""]
+
+def get_git_root(local_dir):
+	return run_git(local_dir, ["rev-parse", "--show-toplevel"]).decode("utf-8").strip()
+
+def get_git_dir(git_root):
+	""" Where the repository itself is. For a submodule that's under the superproject's .git/modules, not git_root/.git """
+	return run_git(git_root, ["rev-parse", "--absolute-git-dir"]).decode("utf-8").strip()
+
+def list_submodules(git_root):
+	""" Paths (relative to git_root) of the checked out submodules directly in this working tree, from the gitlinks in the index. """
+	if not os.path.exists(os.path.join(git_root, ".gitmodules")):
+		return [] # saves a git call for the common case of no submodules
+	submodules = []
+	for entry in split_z(run_git(git_root, ["ls-files", "--stage", "-z"])):
+		meta, path = entry.split("\t", 1)
+		if meta.startswith("160000 ") and os.path.exists(os.path.join(git_root, path, ".git")):
+			submodules.append(path)
+	return submodules
+
+def discover_sync_units(git_root):
+	"""
+	The superproject and every checked out submodule below it (recursively), as a list of
+	(git_root, [paths of its own direct submodules, relative to it]), superproject first.
+	Each is a working tree that can be synced on its own, leaving out its submodules.
+	"""
+	units = []
+	pending = [git_root]
+	while pending:
+		root = pending.pop(0)
+		submodules = list_submodules(root)
+		units.append((root, submodules))
+		pending += [os.path.join(root, path) for path in submodules]
+	return units
+
+def get_head(git_root):
+	""" The commit HEAD points to, or None for a repo with no commits yet. """
+	try:
+		return run_git(git_root, ["rev-parse", "--verify", "-q", "HEAD"]).decode("utf-8").strip()
+	except RuntimeError:
+		return None
+
+def commit_exists(git_root, commit):
+	try:
+		run_git(git_root, ["cat-file", "-e", f"{commit}^{{commit}}"])
+		return True
+	except RuntimeError:
+		return False
+
+def list_dirty_paths(git_root, head, ignore_submodules=False):
+	"""
+	Use the index to find the paths that differ from HEAD, without hashing anything.
+	Returns (changed, deleted): tracked modified/added files plus untracked non-ignored
+	files, and tracked files that no longer exist in the working tree.
+	With ignore_submodules, git doesn't look inside submodules at all, which saves checking
+	each of their working trees in turn when they're synced as their own units anyway.
+	"""
+	changed, deleted = set(), set()
+
+	if head is not None:
+		# worktree (and index) vs HEAD, as 'status\0path\0' pairs
+		entries = split_z(run_git(git_root, ["diff", "--name-status", "--no-renames", "-z"] + (["--ignore-submodules=all"] if ignore_submodules else []) + ["HEAD"]))
+		for status, path in zip(entries[0::2], entries[1::2]):
+			if status == "D":
+				deleted.add(path)
+			else:
+				changed.add(path)
+	else:
+		changed.update(split_z(run_git(git_root, ["ls-files", "-z"])))
+
+	changed.update(split_z(run_git(git_root, ["ls-files", "-o", "--exclude-standard", "-z"])))
+
+	# submodules are synced as their own units, and show up here as directories
+	changed = {p for p in changed if not os.path.isdir(os.path.join(git_root, p)) or os.path.islink(os.path.join(git_root, p))}
+	return changed, deleted
+
+def hash_link(full_path):
+	""" The object id git gives a symlink: the hash of a blob holding its target. """
+	target = os.fsencode(os.readlink(full_path))
+	return hashlib.sha1(b"blob %d\0" % len(target) + target).hexdigest()
+
+def hash_paths(git_root, paths):
+	""" Git modes and object ids ("<mode> <oid>") of the given working tree files, as they are now on disk. """
+	oids = {}
+	regular = []
+	for path in sorted(paths):
+		full_path = os.path.join(git_root, path)
+		if os.path.islink(full_path):
+			oids[path] = "120000 " + hash_link(full_path) # hash-object follows links, so hash the target the way git stores it
+		elif os.path.isfile(full_path):
+			regular.append(path)
+
+	if regular:
+		raw = run_git(git_root, ["hash-object", "--no-filters", "--stdin-paths"], stdin="\n".join(regular).encode("utf-8", errors="surrogateescape") + b"\n")
+		for path, oid in zip(regular, raw.decode("utf-8").split()):
+			# git only tracks the executable bit, so a chmod +x is a change worth syncing but a chmod g+w isn't
+			mode = "100755" if os.stat(os.path.join(git_root, path)).st_mode & 0o100 else "100644"
+			oids[path] = f"{mode} {oid}"
+	return oids
+
+def blob_oids_at(git_root, commit, paths):
+	""" Modes and object ids ("<mode> <oid>") of the given paths in a commit, or None where a path isn't a file in it. """
+	paths = sorted(paths)
+	oids = {path: None for path in paths}
+	if commit is None:
+		return oids
+
+	for i in range(0, len(paths), LS_TREE_BATCH):
+		# cat-file --batch-check can't report modes (before git 2.42), so this uses ls-tree, with the paths taken literally rather than as globs
+		raw = run_git(git_root, ["--literal-pathspecs", "ls-tree", "-z", "--full-name", commit, "--"] + paths[i:i + LS_TREE_BATCH])
+		for entry in split_z(raw):
+			meta, path = entry.split("\t", 1)
+			mode, object_type, oid = meta.split()
+			if object_type == "blob" and path in oids:
+				oids[path] = f"{mode} {oid}"
+	return oids
+
+def changed_between_commits(git_root, old_commit, new_commit):
+	""" Paths whose blobs differ between two commits, without walking either tree on disk. """
+	if old_commit == new_commit:
+		return set()
+	entries = split_z(run_git(git_root, ["diff", "--raw", "--no-renames", "-z", old_commit, new_commit]))
+	paths = set()
+	for meta, path in zip(entries[0::2], entries[1::2]):
+		old_mode, new_mode = meta.lstrip(":").split()[:2]
+		if "160000" in (old_mode, new_mode): # gitlink, ie a submodule
+			continue
+		paths.add(path)
+	return paths
+
+def build_manifest(git_root, head, ignore_submodules=False):
+	""" Describe the current working tree as HEAD plus the paths that differ from it. """
+	changed, deleted = list_dirty_paths(git_root, head, ignore_submodules)
+	dirty = hash_paths(git_root, changed)
+	dirty.update({path: None for path in deleted})
+	return {"version": MANIFEST_VERSION, "head": head, "dirty": dirty}
+
+def compute_changes(git_root, old_manifest, ignore_submodules=False):
+	"""
+	Compare what the container was last given against the working tree now.
+
+	Only paths that git reports as possibly different are looked at:
+	the commit diff between the old and new HEAD, and the dirty sets of both.
+	Each candidate's object id then decides whether it really needs sending.
+
+	Returns (to_send, to_delete, new_manifest, candidate_count), or None for
+	to_send/to_delete if the old manifest can't be used and a full sync is needed.
+	That's always the case for a tree with checked out submodules, unless ignore_submodules
+	says they're synced separately, as the manifest doesn't cover what's inside them.
+	"""
+	head = get_head(git_root)
+	new_manifest = build_manifest(git_root, head, ignore_submodules)
+
+	if not ignore_submodules and list_submodules(git_root):
+		return None, None, new_manifest, 0
+
+	if old_manifest is None or old_manifest.get("version") != MANIFEST_VERSION:
+		return None, None, new_manifest, 0
+
+	old_head = old_manifest["head"]
+	if old_head is not None and not commit_exists(git_root, old_head):
+		return None, None, new_manifest, 0 # e.g. a rewritten/gc'ed commit, so nothing to diff against
+
+	old_dirty, new_dirty = old_manifest["dirty"], new_manifest["dirty"]
+	candidates = set(old_dirty) | set(new_dirty)
+	if old_head is not None and head is not None:
+		candidates |= changed_between_commits(git_root, old_head, head)
+	elif old_head != head:
+		candidates |= set(split_z(run_git(git_root, ["ls-tree", "-r", "--name-only", "-z", old_head or head])))
+
+	old_oids = blob_oids_at(git_root, old_head, candidates - set(old_dirty))
+	old_oids.update(old_dirty)
+	new_oids = blob_oids_at(git_root, head, candidates - set(new_dirty))
+	new_oids.update(new_dirty)
+
+	to_send, to_delete = [], []
+	for path in sorted(candidates):
+		if old_oids[path] == new_oids[path]:
+			continue # the container already has this content
+		if new_oids[path] is None:
+			to_delete.append(path)
+		else:
+			to_send.append(path)
+
+	return to_send, to_delete, new_manifest, len(candidates)
+
+def get_manifest_path(remote_git_root, user="ubuntu"):
+	# one manifest per remote working tree, in a flat dir so it can't be rsync'd over or deleted
+	# named by a hash of the path, as flattening the path itself can map different trees to one name
+	key = hashlib.sha1(remote_git_root.rstrip("/").encode("utf-8", errors="surrogateescape")).hexdigest()[:16]
+	return posixpath.join(f"/home/{user}/.cache/incusdev/git_sync", key + ".json")
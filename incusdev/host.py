@@ -1,4 +1,4 @@
-import os, sys, subprocess, time
+import os, sys, shlex, subprocess, time
 
 def as_array(result_or_error):
 	return result_or_error.decode("utf-8").split("\n")[:-1] if result_or_error != None else []
@@ -53,3 +53,10 @@ def run_local_cmd_realtime(cmd, **kwargs):
 
 def run_local_gui_cmd(cmd):
 	subprocess.run(cmd, shell=True)
+
+def run_incus(incus_cmd, *args, check=True):
+	""" Run an incus command (incus_cmd can be a stand-in, see tests/fake_incus.py), returning its stdout as a string. """
+	result = subprocess.run(shlex.split(incus_cmd) + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if check and result.returncode != 0:
+		raise RuntimeError(f"incus {' '.join(args)} failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+	return result.stdout.decode("utf-8")
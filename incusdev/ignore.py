@@ -0,0 +1,256 @@
+"""Gitignore-aware ignore rules for syncing, compiled once into regexes so ignored directories can be pruned."""
+import os, re, tempfile
+
+from .log import LOGGER
+
+# read in every directory, with later files (and deeper directories) taking precedence
+IGNORE_FILENAMES = [".gitignore", ".incusdevignore"]
+
+def glob_to_regex(glob):
+	""" Translate one gitignore glob (already stripped of !, leading / and trailing /) into a regex. """
+	regex = ""
+	i = 0
+	while i < len(glob):
+		if glob.startswith("**/", i):
+			regex += "(?:.*/)?"
+			i += 3
+		elif glob.startswith("/**", i) and i + 3 == len(glob):
+			regex += "/.*"
+			i += 3
+		elif glob.startswith("**", i):
+			regex += ".*"
+			i += 2
+		elif glob[i] == "*":
+			regex += "[^/]*"
+			i += 1
+		elif glob[i] == "?":
+			regex += "[^/]"
+			i += 1
+		elif glob[i] == "[" and "]" in glob[i+2:]:
+			end = glob.index("]", i+2)
+			body = glob[i+1:end]
+			regex += "[" + ("^" + body[1:] if body[0] == "!" else body).replace("\\", "\\\\") + "]"
+			i = end + 1
+		elif glob[i] == "\\" and i + 1 < len(glob):
+			regex += re.escape(glob[i+1])
+			i += 2
+		else:
+			regex += re.escape(glob[i])
+			i += 1
+	return regex
+
+class Rule:
+	""" One line of an ignore file. """
+
+	def __init__(self, line):
+		self.original = line
+		self.negated = line.startswith("!")
+		if self.negated:
+			line = line[1:]
+		self.dir_only = line.endswith("/")
+		line = line.rstrip("/")
+		# a pattern with a slash before its end is relative to the ignore file's directory, otherwise it matches at any depth
+		self.anchored = "/" in line
+		self.pattern = line.lstrip("/")
+		self.regex = ("" if self.anchored else "(?:.*/)?") + glob_to_regex(self.pattern)
+
+def parse_rules(text):
+	rules = []
+	for line in text.split("\n"):
+		if line.endswith("\\ "):
+			line = line.rstrip(" ") + " " # an escaped trailing space is kept
+		else:
+			line = line.rstrip(" \r")
+		if line == "" or line.startswith("#"):
+			continue
+		if line.startswith("\\#") or line.startswith("\\!"):
+			line = line[1:]
+		rules.append(Rule(line))
+	return rules
+
+class RuleSet:
+	"""
+	The rules that apply from one directory down, compiled into a few regexes.
+	Runs of consecutive rules with the same polarity are merged into one alternation,
+	so matching a path is a handful of regex calls however many rules there are.
+	"""
+
+	def __init__(self, base, rules):
+		self.base = base # relative to the sync root, "" for the root
+		self.rules = rules
+		self.runs = [] # [(negated, file_regex, dir_regex)], in file order
+		for rule in rules:
+			if not self.runs or self.runs[-1][0] != rule.negated:
+				self.runs.append((rule.negated, [], []))
+			self.runs[-1][2].append(rule.regex)
+			if not rule.dir_only:
+				self.runs[-1][1].append(rule.regex)
+		self.runs = [(negated, self.compile(file_res), self.compile(dir_res)) for negated, file_res, dir_res in self.runs]
+
+	@staticmethod
+	def compile(regexes):
+		return re.compile("(?:" + "|".join(regexes) + ")$") if regexes else None
+
+	def match(self, rel_path, is_dir):
+		""" True if ignored, False if re-included by a ! rule, None if no rule here says anything. """
+		for negated, file_regex, dir_regex in reversed(self.runs): # the last matching rule wins
+			regex = dir_regex if is_dir else file_regex
+			if regex is not None and regex.match(rel_path):
+				return not negated
+		return None
+
+class IgnoreRules:
+	"""
+	The ignore rules for a sync root: .gitignore files at every level (including those
+	between the git root and the sync root), .git/info/exclude, and .incusdevignore files.
+	"""
+
+	def __init__(self, root):
+		self.root = os.path.abspath(root)
+		self.rulesets = {} # keyed by directory relative to root
+		self.ancestor_rulesets = [] # rules from the git root down to (but not including) the sync root
+		self.stats = {"pruned_dirs": 0, "ignored_files": 0, "ignored_bytes": 0}
+
+		git_root = self.find_git_root()
+		if git_root is not None:
+			exclude_path = os.path.join(git_root, ".git", "info", "exclude")
+			self.ancestor_rulesets += self.load_ancestor(git_root, [exclude_path])
+			rel_root = os.path.relpath(self.root, git_root)
+			parts = [] if rel_root == "." else rel_root.split(os.sep)
+			for depth in range(len(parts)):
+				ancestor = os.path.join(git_root, *parts[:depth])
+				self.ancestor_rulesets += self.load_ancestor(ancestor, [os.path.join(ancestor, f) for f in IGNORE_FILENAMES])
+		self.load_dir("")
+
+	def find_git_root(self):
+		path = self.root
+		while True:
+			if os.path.exists(os.path.join(path, ".git")):
+				return path
+			parent = os.path.dirname(path)
+			if parent == path:
+				return None
+			path = parent
+
+	def load_ancestor(self, directory, filenames):
+		rules = []
+		for filename in filenames:
+			rules += self.read_rules(filename)
+		# keep the ancestor directory's relative location, so anchored patterns can be re-based later
+		return [(os.path.relpath(self.root, directory), RuleSet("", rules))] if rules else []
+
+	@staticmethod
+	def read_rules(filename):
+		try:
+			with open(filename, encoding="utf-8", errors="replace") as f:
+				return parse_rules(f.read())
+		except OSError:
+			return []
+
+	def load_dir(self, rel_dir):
+		rules = []
+		for filename in IGNORE_FILENAMES:
+			rules += self.read_rules(os.path.join(self.root, rel_dir, filename))
+		if rules:
+			self.rulesets[rel_dir] = RuleSet(rel_dir, rules)
+
+	def is_ignored(self, rel_path, is_dir):
+		"""
+		Check a path (relative to the sync root, using /) against every rule set that covers it, deepest first.
+		Parent directories aren't checked here, walk() covers that by never descending into ignored ones.
+		"""
+		parts = rel_path.split("/")
+		for depth in range(len(parts) - 1, -1, -1):
+			base = "/".join(parts[:depth])
+			ruleset = self.rulesets.get(base)
+			if ruleset is not None:
+				result = ruleset.match("/".join(parts[depth:]), is_dir)
+				if result is not None:
+					return result
+		for prefix, ruleset in reversed(self.ancestor_rulesets):
+			result = ruleset.match(os.path.normpath(os.path.join(prefix, rel_path)).replace(os.sep, "/"), is_dir)
+			if result is not None:
+				return result
+		return False
+
+	def walk(self, skip_dirs=(".git",), skip_paths=()):
+		"""
+		Walk the sync root, pruning ignored directories rather than descending into them,
+		and picking up nested ignore files as they're reached. Yields kept file paths (relative).
+		The sizes of pruned directories aren't measured, as that would defeat the pruning.
+		Directories named in skip_dirs aren't walked into at all, as they hold no ignore files,
+		nor are those at skip_paths (relative, e.g. submodules that are synced separately).
+		"""
+		stack = [""]
+		while stack:
+			rel_dir = stack.pop()
+			if rel_dir != "":
+				self.load_dir(rel_dir)
+			try:
+				entries = list(os.scandir(os.path.join(self.root, rel_dir)))
+			except OSError:
+				continue
+			for entry in entries:
+				rel_path = entry.name if rel_dir == "" else rel_dir + "/" + entry.name
+				is_dir = entry.is_dir(follow_symlinks=False)
+				if self.is_ignored(rel_path, is_dir):
+					if is_dir:
+						self.stats["pruned_dirs"] += 1
+					else:
+						self.stats["ignored_files"] += 1
+						self.stats["ignored_bytes"] += entry.stat(follow_symlinks=False).st_size
+				elif is_dir:
+					if entry.name not in skip_dirs and rel_path not in skip_paths:
+						stack.append(rel_path)
+				else:
+					yield rel_path
+
+	def rsync_filter_rules(self):
+		"""
+		The same rules, as rsync include/exclude lines relative to the sync root.
+		rsync uses the first matching rule, so the order is reversed from gitignore's last-match-wins.
+		Plain +/- rules apply on the receiving side too, so with --delete the container's
+		copies of ignored paths (e.g. container-only build products) are left alone.
+		"""
+		lines = []
+		def add(base, rule, pattern=None):
+			pattern = rule.pattern if pattern is None else pattern
+			prefix = "+ " if rule.negated else "- "
+			suffix = "/" if rule.dir_only else ""
+			if rule.anchored:
+				lines.append(prefix + "/" + (base + "/" if base else "") + pattern + suffix)
+			elif base:
+				lines.append(prefix + "/" + base + "/" + pattern + suffix)
+				lines.append(prefix + "/" + base + "/**/" + pattern + suffix)
+			else:
+				lines.append(prefix + pattern + suffix)
+
+		for prefix, ruleset in self.ancestor_rulesets:
+			prefix = prefix.replace(os.sep, "/")
+			prefix = "" if prefix == "." else prefix + "/" # "." when the sync root is the git root, e.g. for .git/info/exclude
+			for rule in ruleset.rules:
+				if not rule.anchored:
+					add("", rule)
+				elif rule.pattern.startswith(prefix):
+					add("", rule, rule.pattern[len(prefix):]) # anchored patterns outside the sync root can't match anything in it
+		for base in sorted(self.rulesets):
+			for rule in self.rulesets[base].rules:
+				add(base, rule)
+		return list(reversed(lines))
+
+def make_rsync_exclude_file(root, skip_paths=()):
+	"""
+	Compile the ignore rules for root, walk it once (to find nested ignore files and count
+	what's skipped, without going into .git or skip_paths), and write the rules to a temporary file for rsync's --exclude-from.
+	Returns (the temporary file, stats about what was skipped).
+	"""
+	rules = IgnoreRules(root)
+	kept_files = sum(1 for _ in rules.walk(skip_paths=set(skip_paths)))
+	stats = dict(rules.stats, kept_files=kept_files)
+
+	exclude_fp = tempfile.NamedTemporaryFile(mode="w", delete=True)
+	exclude_fp.write("\n".join(rules.rsync_filter_rules()) + "\n")
+	exclude_fp.flush()
+
+	LOGGER.info(f"Ignoring {stats['pruned_dirs']} directories and {stats['ignored_files']} files ({stats['ignored_bytes']/1e6:.1f} MB) under {root}")
+	return exclude_fp, stats
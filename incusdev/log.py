@@ -28,10 +28,10 @@ def log_formatter(record: dict) -> str:
 	return "<fg #70acde>{time:MM-DD-YYYY HH:mm:ss}</fg #70acde> | <fg #b3cfe7>{level}</fg #b3cfe7>: <light-white>{message}</light-white>\n"
 
 
-def create_logger() -> custom_logger:
-	"""Create custom logger."""
+def create_logger(sink=stdout) -> custom_logger:
+	"""Create custom logger, or point the existing one at a different sink."""
 	custom_logger.remove()
-	custom_logger.add(stdout, colorize=True, format=log_formatter)
+	custom_logger.add(sink, colorize=True, format=log_formatter)
 	return custom_logger
 
 
@@ -0,0 +1,88 @@
+"""A pipeline of precompiled filters that command output lines pass through before they're logged."""
+import os, re
+
+from .paths import local_filename_from_remote
+
+class OutputLine:
+	""" One line of command output, as it moves through the pipeline. """
+	__slots__ = ["text", "stream", "level"]
+
+	def __init__(self, text, stream, level):
+		self.text = text
+		self.stream = stream # "stdout" or "stderr"
+		self.level = level # the LOGGER level name it'll be logged at
+
+class AnsiFilter:
+	""" Strips ANSI escape sequences (colours, cursor movement), e.g. when logs aren't going to a terminal. """
+
+	ANSI_RE = re.compile(r"\x1b\[[0-9;?]*[ -/]*[@-~]|\x1b\][^\x07]*\x07")
+
+	def __call__(self, line):
+		if "\x1b" in line.text:
+			line.text = self.ANSI_RE.sub("", line.text)
+		return [line]
+
+class ClassifyFilter:
+	"""
+	Sets each line's level from what it says, rather than only which stream it came on.
+	stderr lines are errors unless they look like a warning (and not also an error),
+	and stdout lines are info unless they look like an error or warning.
+	"""
+
+	ERROR_RE = re.compile(r"\b(error|exception|traceback|fatal|failed|failure)\b", re.IGNORECASE)
+	WARNING_RE = re.compile(r"\b(warn|warning|warnings|deprecat\w*)\b", re.IGNORECASE)
+
+	def __call__(self, line):
+		if self.WARNING_RE.search(line.text) and not self.ERROR_RE.search(line.text):
+			line.level = "WARNING"
+		elif line.stream == "stderr" or self.ERROR_RE.search(line.text):
+			line.level = "ERROR"
+		return [line]
+
+class PathRewriteFilter:
+	"""
+	For lines mentioning a file in the container (in /home/ubuntu/from_host/...), adds an extra
+	line with the matching host path, so in vscode you can just click it and be taken to the file.
+	Paths under the caller's working directory are given relative to it, e.g. ./tests/x.py
+	"""
+
+	REMOTE_PREFIX = "/home/ubuntu/from_host/"
+	PATH_RE = re.compile(re.escape(REMOTE_PREFIX) + r"[^\s\"'(),:;<>]+")
+
+	def __init__(self, local_cwd=None):
+		# worked out once, rather than on every line
+		self.local_cwd = (local_cwd or os.getcwd()).rstrip("/") + "/"
+
+	def local_reference(self, remote_path):
+		local_path = local_filename_from_remote(remote_path)
+		if local_path.startswith(self.local_cwd):
+			return "./" + local_path[len(self.local_cwd):]
+		return local_path
+
+	def __call__(self, line):
+		if self.REMOTE_PREFIX not in line.text: # much cheaper than the regex, and true for most lines
+			return [line]
+		references = [self.local_reference(m.group(0)) for m in self.PATH_RE.finditer(line.text)]
+		# e.g. '  File "/home/ubuntu/from_host/x/Documents/git_repos/gateware/amaram/tests/fpga_io_sim.py", line 28, in <module>'
+		# gets '(Local file reference: ./tests/fpga_io_sim.py)' after it
+		return [line] + [OutputLine(f"(Local file reference: {r})", line.stream, line.level) for r in references]
+
+class OutputPipeline:
+	""" Runs each line of output through a list of filters in order. Each filter can change, drop or add lines. """
+
+	def __init__(self, filters):
+		self.filters = filters
+
+	def process(self, text, stream):
+		lines = [OutputLine(text, stream, "ERROR" if stream == "stderr" else "INFO")]
+		for output_filter in self.filters:
+			lines = [out for line in lines for out in output_filter(line)]
+		return lines
+
+	def without(self, filter_type):
+		""" A copy of this pipeline with any filters of the given type removed. """
+		return OutputPipeline([f for f in self.filters if not isinstance(f, filter_type)])
+
+def default_pipeline(local_cwd=None, strip_ansi=False):
+	filters = [AnsiFilter()] if strip_ansi else []
+	return OutputPipeline(filters + [ClassifyFilter(), PathRewriteFilter(local_cwd)])
@@ -0,0 +1,11 @@
+"""Mapping between host paths and where they live in the container. Kept free of heavy imports, so path queries start fast."""
+
+def remote_filename_from_local(local_filename):
+	""" Where a file in the host user's home folder lives in the container. """
+	assert "home" in local_filename, f"content must be in the host user's home folder, which is currently: {local_filename}"
+	return local_filename.replace("/home/", "/home/ubuntu/from_host/") # don't use ~ here as it makes it harder to match path strings
+
+def local_filename_from_remote(remote_filename):
+	""" The opposite of remote_filename_from_local. """
+	assert remote_filename.startswith("/home/ubuntu/from_host"), f"remote_filename must start with /home/ubuntu/from_host"
+	return remote_filename.replace("/home/ubuntu/from_host/", "/home/")
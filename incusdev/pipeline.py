@@ -0,0 +1,148 @@
+"""Run several sync, exec and pull steps, with dependencies between them, over one shared RemoteClient."""
+import json, time, shlex
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .log import LOGGER
+
+# what each step's "do" can be, and the RemoteClient call it makes
+ACTIONS = ["sync", "git_sync", "git_sync_submodules", "sync_back", "exec", "pull"]
+
+WORKERS = 4
+
+class Step:
+	"""
+	One step of a pipeline, e.g. from a pipeline file:
+		{"name": "build", "do": "exec", "run": ["make -j8"], "after": ["sync"]}
+	"""
+
+	def __init__(self, name, do, after=(), run=(), patterns=(), delete=False):
+		assert do in ACTIONS, f"Invalid step action '{do}', should be one of {ACTIONS}"
+		self.name = name
+		self.do = do
+		self.after = list(after) # names of steps that have to succeed first
+		self.run = [run] if isinstance(run, str) else list(run) # commands, for exec
+		self.patterns = [patterns] if isinstance(patterns, str) else list(patterns) # globs, for pull
+		self.delete = delete # for the sync steps
+
+	def __repr__(self):
+		return f"Step({self.name!r}, {self.do!r}, after={self.after})"
+
+	def execute(self, client, on_progress=None):
+		""" Run this step on the client. Returns a dict for the step's result, or raises if it failed. """
+		if self.do == "sync":
+			return client.rsync_to_container(delete=self.delete, on_progress=on_progress).as_dict()
+		elif self.do == "git_sync":
+			return client.git_sync_to_container(delete=self.delete, on_progress=on_progress).as_dict()
+		elif self.do == "git_sync_submodules":
+			return client.git_sync_submodules_to_container(delete=self.delete, on_progress=on_progress).as_dict()
+		elif self.do == "sync_back":
+			return client.rsync_from_container(delete=self.delete, on_progress=on_progress).as_dict()
+		elif self.do == "pull":
+			return client.pull_artifacts(self.patterns).as_dict()
+		elif self.do == "exec":
+			# one round trip, stopping at the first command that fails
+			results = client.execute_batch(self.run, within_remote_working_dir=True, stop_on_failure=True, raise_on_failure=True)
+			return {"exit_codes": [r.exit_code for r in results], "command_sec": [r.duration_sec for r in results]}
+
+class StepResult:
+	""" How one step went: "ok", "failed", or "skipped" (when an earlier failure stopped the pipeline). """
+
+	def __init__(self, name, status, elapsed_sec=0.0, result=None, error=None):
+		self.name = name
+		self.status = status
+		self.elapsed_sec = elapsed_sec
+		self.result = result
+		self.error = error
+
+	def as_dict(self):
+		return {"step": self.name, "status": self.status, "elapsed_sec": self.elapsed_sec, "result": self.result, "error": self.error}
+
+def parse_inline(text):
+	"""
+	Steps from a one line description, run one after another, e.g.
+		"sync -> exec make -j8 -> pull Outputs/**/*.bit"
+	Each part is an action followed by its arguments (commands for exec, globs for pull,
+	'delete' for the sync actions). Steps are named after their position, e.g. "2_exec".
+	"""
+	steps = []
+	for i, part in enumerate(p.strip() for p in text.split("->")):
+		do, _, rest = part.partition(" ")
+		name = f"{i + 1}_{do}"
+		after = [steps[-1].name] if steps else []
+		if do == "exec":
+			steps.append(Step(name, do, after, run=rest.strip()))
+		elif do == "pull":
+			steps.append(Step(name, do, after, patterns=shlex.split(rest)))
+		else:
+			steps.append(Step(name, do, after, delete=rest.strip() == "delete"))
+	return steps
+
+def load_pipeline_file(path):
+	""" Steps from a json file of the form {"steps": [{"name": ..., "do": ..., "after": [...], ...}]} """
+	with open(path) as f:
+		content = json.load(f)
+	return [Step(**step) for step in content["steps"]]
+
+def check_steps(steps):
+	""" Make sure names are unique, every dependency exists, and there are no cycles. """
+	names = [step.name for step in steps]
+	assert len(set(names)) == len(names), f"Step names must be unique: {names}"
+	by_name = {step.name: step for step in steps}
+	for step in steps:
+		for dependency in step.after:
+			assert dependency in by_name, f"Step '{step.name}' is after '{dependency}', which isn't a step"
+
+	done = set()
+	remaining = list(steps)
+	while remaining:
+		ready = [step for step in remaining if set(step.after) <= done]
+		assert ready, f"These steps depend on each other in a cycle: {[step.name for step in remaining]}"
+		done.update(step.name for step in ready)
+		remaining = [step for step in remaining if step not in ready]
+
+def run_pipeline(client, steps, workers=WORKERS, on_step=None, on_progress=None):
+	"""
+	Run the steps on one client, each as soon as the steps it's after have succeeded,
+	so independent steps run at the same time. If a step fails, nothing new is started
+	(steps already running are left to finish) and the rest are marked as skipped.
+
+	on_step is called with each finished StepResult's dict. Returns the StepResults, in step order.
+	"""
+	check_steps(steps)
+	results = {}
+	running = {} # future: (step, start time)
+
+	def finish(step, status, start_time, result=None, error=None):
+		results[step.name] = StepResult(step.name, status, time.time() - start_time, result, error)
+		log = LOGGER.info if status == "ok" else LOGGER.error
+		log(f"Step '{step.name}' {status} in {results[step.name].elapsed_sec:.2f}s" + (f": {error}" if error else ""))
+		if on_step is not None:
+			on_step(results[step.name].as_dict())
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		failed = False
+		while True:
+			if not failed:
+				started = {s.name for s, _ in running.values()}
+				for step in steps:
+					if step.name not in results and step.name not in started and all(results.get(d) is not None and results[d].status == "ok" for d in step.after):
+						LOGGER.info(f"Starting step '{step.name}' ({step.do})")
+						running[executor.submit(step.execute, client, on_progress)] = (step, time.time())
+			if not running:
+				break
+
+			finished, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in finished:
+				step, start_time = running.pop(future)
+				try:
+					finish(step, "ok", start_time, result=future.result())
+				except Exception as e:
+					finish(step, "failed", start_time, error=str(e))
+					failed = True # fail fast
+
+	for step in steps:
+		if step.name not in results:
+			results[step.name] = StepResult(step.name, "skipped")
+			if on_step is not None:
+				on_step(results[step.name].as_dict())
+	return [results[step.name] for step in steps]
@@ -0,0 +1,247 @@
+"""A warm pool of ephemeral containers, cloned from a snapshot of a template container."""
+import os, json, shlex, fcntl, subprocess, threading, time, uuid, contextlib
+
+from .log import LOGGER
+from .client import make_incus_rsh_file
+from .host import run_incus
+from .paths import remote_filename_from_local
+from . import compression, ignore, progress
+
+# incus config keys used to track pool members, so the pool can be picked up again by later processes
+POOL_KEY = "user.incusdev.pool"
+CREATED_KEY = "user.incusdev.pool_created"
+STATE_KEY = "user.incusdev.pool_state"
+SNAPSHOT_KEY = "user.incusdev.pool_snapshot"
+
+# members are claimed while holding a lock on this file, so two processes can't take the same one
+LOCK_PATH = "~/.cache/incusdev/pool/{template}.lock"
+
+class ContainerPool:
+	"""
+	Keeps `size` started ephemeral containers ready, each cloned from the latest pool
+	snapshot of `template_container`, with the local working directory already synced in.
+
+	acquire() hands a ready container out immediately (only a small delta sync is done
+	if the working directory changed since the clone was made), and the pool is topped
+	back up in a background thread. Ready containers that have been idle for longer
+	than `idle_timeout_sec` are evicted. Containers are ephemeral, so they're deleted
+	by incus once stopped.
+
+	The pool's state lives in incus config keys on the containers themselves, so
+	separate incusdev processes share the same pool, and changes to it are made while
+	holding a file lock per template, so a member is only ever handed to one process.
+	`incus_cmd` can point to a stand-in for the incus binary for testing (see tests/fake_incus.py).
+	"""
+
+	def __init__(self, template_container, local_working_directory, size=2, idle_timeout_sec=30*60, incus_cmd="incus", boot_timeout_sec=60):
+		self.template_container = template_container
+		self.local_working_directory = local_working_directory
+		self.remote_working_directory = remote_filename_from_local(local_working_directory)
+		self.size = size
+		self.idle_timeout_sec = idle_timeout_sec
+		self.incus_cmd = incus_cmd
+		self.boot_timeout_sec = boot_timeout_sec
+
+		self.lock_path = os.path.expanduser(LOCK_PATH.format(template=template_container))
+		self._refill_thread = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.wait_for_refill()
+
+	@contextlib.contextmanager
+	def locked(self):
+		""" Hold the pool's lock, which is shared by every thread and process using this template. """
+		os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+		with open(self.lock_path, "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX) # released when the file is closed
+			yield
+
+	def incus(self, *args, check=True):
+		return run_incus(self.incus_cmd, *args, check=check)
+
+	### template / snapshot
+
+	def get_snapshot(self):
+		return self.incus("config", "get", self.template_container, SNAPSHOT_KEY).strip() or None
+
+	def prepare_template(self):
+		"""
+		Sync the working directory into the template container and take a new pool snapshot of it.
+		Only needed when the template is new, or has drifted a long way from the working directory,
+		as clones are also delta-synced when they're made.
+		"""
+		self.incus("start", self.template_container, check=False) # fails harmlessly if already running
+		self.wait_until_ready(self.template_container)
+		self.sync_into(self.template_container)
+
+		old_snapshot = self.get_snapshot()
+		snapshot = f"incusdev-pool-{int(time.time())}"
+		self.incus("snapshot", "create", self.template_container, snapshot)
+		self.incus("config", "set", self.template_container, f"{SNAPSHOT_KEY}={snapshot}")
+		if old_snapshot is not None:
+			self.incus("snapshot", "delete", self.template_container, old_snapshot, check=False)
+
+		LOGGER.info(f"Pool snapshot {self.template_container}/{snapshot} is ready")
+		return snapshot
+
+	### members
+
+	def list_members(self):
+		""" All containers belonging to this pool, as a list of (name, state, created_timestamp). """
+		members = []
+		for container in json.loads(self.incus("list", "--format", "json") or "[]"):
+			config = container.get("config", {})
+			if config.get(POOL_KEY) == self.template_container:
+				members.append((container["name"], config.get(STATE_KEY, "starting"), float(config.get(CREATED_KEY, 0))))
+		return members
+
+	def ready_members(self):
+		return [m for m in self.list_members() if m[1] == "ready"]
+
+	def clone(self, state="ready"):
+		""" Make, start and sync one new pool member, then mark it with the given state. """
+		return self.start_member(self.create_member(), state)
+
+	def create_member(self):
+		""" Copy a new pool member from the snapshot, marked 'starting' so it counts towards the pool's size straight away. """
+		snapshot = self.get_snapshot()
+		if snapshot is None:
+			snapshot = self.prepare_template()
+
+		name = f"{self.template_container}-pool-{uuid.uuid4().hex[:6]}"
+		self.incus("copy", f"{self.template_container}/{snapshot}", name, "--ephemeral",
+			"--config", f"{POOL_KEY}={self.template_container}",
+			"--config", f"{CREATED_KEY}={time.time()}",
+			"--config", f"{STATE_KEY}=starting")
+		return name
+
+	def start_member(self, name, state="ready"):
+		""" Start and sync a member made by create_member, then mark it with the given state. """
+		self.incus("start", name)
+		self.wait_until_ready(name)
+		self.sync_into(name) # only the changes since the snapshot was taken
+		self.incus("config", "set", name, f"{STATE_KEY}={state}")
+		LOGGER.info(f"Pool container {name} is ready")
+		return name
+
+	def acquire(self, refill=True):
+		""" Hand out a ready container, making one now only if the pool is empty. """
+		with self.locked():
+			ready = sorted(self.ready_members(), key=lambda m: m[2])
+			if ready:
+				name = ready[-1][0] # the newest one has the least to catch up on
+				self.incus("config", "set", name, f"{STATE_KEY}=in_use")
+			else:
+				name = None
+
+		if name is None:
+			LOGGER.warning(f"Pool for {self.template_container} was empty, making a container now")
+			name = self.clone(state="in_use") # never marked ready, so no other process can claim it
+		else:
+			self.sync_into(name)
+
+		if refill:
+			self.refill_in_background()
+		return name
+
+	def release(self, name):
+		""" Remove a container that was handed out. Safe to call more than once. """
+		self.incus("delete", "--force", name, check=False)
+
+	def evict_idle(self):
+		"""
+		Delete containers that have sat unused for longer than idle_timeout_sec.
+		This also cleans up any left 'starting' by a process that died part way through a clone.
+		"""
+		now = time.time()
+		evicted = []
+		with self.locked(): # so a member can't be claimed by another process as it's being deleted
+			for name, state, created in self.list_members():
+				if state != "in_use" and now - created > self.idle_timeout_sec:
+					self.release(name)
+					evicted.append(name)
+		if evicted:
+			LOGGER.info(f"Evicted idle pool containers: {evicted}")
+		return evicted
+
+	def refill(self):
+		"""
+		Top the pool back up to `size`, one container at a time.
+		Each member is created under the lock, so refills running at once can't overshoot,
+		then booted and synced outside it.
+		"""
+		self.evict_idle()
+		while True:
+			name = None
+			try:
+				with self.locked():
+					pending = [m for m in self.list_members() if m[1] in ["ready", "starting"]]
+					if len(pending) >= self.size:
+						break
+					name = self.create_member()
+				self.start_member(name)
+			except Exception as e:
+				LOGGER.error(f"Failed to refill pool for {self.template_container}: {e}")
+				if name is not None:
+					self.release(name)
+				break
+
+	def refill_in_background(self):
+		if self._refill_thread is not None and self._refill_thread.is_alive():
+			return
+		self._refill_thread = threading.Thread(target=self.refill, daemon=True)
+		self._refill_thread.start()
+
+	def wait_for_refill(self):
+		if self._refill_thread is not None:
+			self._refill_thread.join()
+
+	def drain(self):
+		""" Delete every container in the pool that isn't currently handed out. """
+		with self.locked():
+			for name, state, _ in self.list_members():
+				if state != "in_use":
+					self.release(name)
+
+	### helpers
+
+	def wait_until_ready(self, name):
+		deadline = time.time() + self.boot_timeout_sec
+		while subprocess.run(shlex.split(self.incus_cmd) + ["exec", name, "--", "test", "-d", "/home/ubuntu"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+			if time.time() > deadline:
+				raise RuntimeError(f"{name} didn't become ready within {self.boot_timeout_sec}s")
+			time.sleep(0.5)
+
+	def sync_into(self, name):
+		""" rsync the working directory into a pool container over incus exec, so no ssh config is needed for it. """
+		fake_ssh_fp = make_incus_rsh_file(self.incus_cmd)
+		self.incus("exec", name, "--user", "1000", "--", "mkdir", "-p", self.remote_working_directory)
+		exclude_fp, _ = ignore.make_rsync_exclude_file(self.local_working_directory)
+		compression_args, _ = compression.rsync_compression_args(name, self.local_working_directory, incus_cmd=self.incus_cmd, cache_key=self.template_container)
+		return self.run_rsync(compression_args + [f"--exclude-from={exclude_fp.name}", "--chown=ubuntu:ubuntu", "-e", fake_ssh_fp.name,
+			self.local_working_directory + "/", f"{name}:{self.remote_working_directory}/"])
+
+	def sync_out_of(self, name, delete=False):
+		"""
+		rsync the working directory back out of a pool container, e.g. before releasing it.
+		Host files that aren't in the container (e.g. made while the program ran) are kept,
+		unless delete is set, as with 'rsync_from_container ... keep'.
+		"""
+		fake_ssh_fp = make_incus_rsh_file(self.incus_cmd)
+		exclude_fp, _ = ignore.make_rsync_exclude_file(self.local_working_directory)
+		compression_args, _ = compression.rsync_compression_args(name, self.local_working_directory, incus_cmd=self.incus_cmd, cache_key=self.template_container, remote_dir=self.remote_working_directory)
+		# --update leaves alone any host file that was edited since it was synced in, rather than putting the container's older copy over it
+		return self.run_rsync(compression_args + ["--update", f"--exclude-from={exclude_fp.name}", "-e", fake_ssh_fp.name,
+			f"{name}:{self.remote_working_directory}/", self.local_working_directory + "/"], delete=delete)
+
+	def run_rsync(self, args, delete=True):
+		return progress.run_rsync_resumable(["rsync", "-a"] + (["--delete"] if delete else []) + args)
+
+	def run_program(self, name, programname, arguments=""):
+		""" Run a program as the ubuntu user in a pool container's working directory, attached to this terminal. """
+		return subprocess.run(shlex.split(self.incus_cmd) + ["exec", name,
+			"--user", "1000", "--group", "1000", "--env", "HOME=/home/ubuntu", "--cwd", self.remote_working_directory,
+			"--", "bash", "-lc", f"{programname} {arguments}"]).returncode
@@ -0,0 +1,226 @@
+"""Run rsync with its output streamed as it happens, turning it into progress events and a structured result."""
+import re, subprocess, threading, time
+
+from .log import LOGGER
+
+# from the EXIT VALUES section of the rsync man page
+RSYNC_EXIT_CODES = {
+	0: "success",
+	1: "syntax or usage error",
+	2: "protocol incompatibility",
+	3: "errors selecting input/output files, dirs",
+	4: "requested action not supported",
+	5: "error starting client-server protocol",
+	6: "daemon unable to append to log-file",
+	10: "error in socket I/O",
+	11: "error in file I/O",
+	12: "error in rsync protocol data stream",
+	13: "errors with program diagnostics",
+	14: "error in IPC code",
+	20: "received SIGUSR1 or SIGINT",
+	21: "some error returned by waitpid()",
+	22: "error allocating core memory buffers",
+	23: "partial transfer due to error",
+	24: "partial transfer due to vanished source files",
+	25: "the --max-delete limit stopped deletions",
+	30: "timeout in data send/receive",
+	35: "timeout waiting for daemon connection",
+	255: "the remote shell (incus exec) failed or was disconnected",
+}
+
+# files disappearing mid-transfer is normal in a working directory that's being edited
+RSYNC_WARNING_EXIT_CODES = [24]
+
+# the connection to the container broke (e.g. the laptop was suspended), rather than anything
+# being wrong with the transfer itself, so running it again can carry on from where it got to
+RSYNC_RESUMABLE_EXIT_CODES = [10, 12, 30, 35, 255]
+RSYNC_ATTEMPTS = 5
+
+# partly sent files are kept here (relative to the destination) so a resumed transfer continues them,
+# and as it's relative, rsync leaves it out of the transfer and out of --delete by itself
+PARTIAL_DIR = ".rsync-partial"
+
+RETRY_BACKOFF_SEC = 1
+MAX_BACKOFF_SEC = 30
+
+# what rsync prints for --info=progress2, e.g. '  1,238,099  45%  146.38MB/s    0:00:12 (xfr#3, to-chk=10/20)'
+PROGRESS_RE = re.compile(r"^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?B)/s\s+(\S+)(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?")
+RATE_UNITS = {"B": 1, "kB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12}
+
+# what rsync prints for --stats, mapped to SyncResult attributes
+STATS_RE = {
+	"files_transferred": re.compile(r"^Number of regular files transferred: ([\d,]+)"),
+	"files_deleted": re.compile(r"^Number of deleted files: ([\d,]+)"),
+	"bytes_sent": re.compile(r"^Total bytes sent: ([\d,]+)"),
+	"bytes_received": re.compile(r"^Total bytes received: ([\d,]+)"),
+}
+
+class RsyncError(Exception):
+	""" rsync exited with a code that means the transfer didn't complete. """
+
+	def __init__(self, exit_code, error_lines):
+		self.exit_code = exit_code
+		self.meaning = RSYNC_EXIT_CODES.get(exit_code, "unknown error")
+		self.error_lines = error_lines
+		super().__init__(f"rsync exited with {exit_code} ({self.meaning}): {' / '.join(error_lines[-3:])}")
+
+class SyncResult:
+	""" What a sync did, summed over however many rsync runs it took. """
+
+	def __init__(self):
+		self.files_transferred = 0
+		self.files_deleted = 0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.elapsed_sec = 0.0
+		self.exit_code = 0
+		self.warnings = []
+		self.reconnects = 0 # times the ssh connection was re-established during the sync
+		self.resumes = 0 # times an interrupted transfer was picked up again
+		self.details = {} # anything specific to how the sync was done, e.g. compression, ignore rules, git mode
+
+	@property
+	def bytes_per_sec(self):
+		return (self.bytes_sent + self.bytes_received) / self.elapsed_sec if self.elapsed_sec > 0 else 0.0
+
+	def add(self, other):
+		""" Fold another result into this one, e.g. when one sync is made of several rsync runs. """
+		for name in ["files_transferred", "files_deleted", "bytes_sent", "bytes_received", "elapsed_sec", "reconnects", "resumes"]:
+			setattr(self, name, getattr(self, name) + getattr(other, name))
+		self.exit_code = self.exit_code or other.exit_code
+		self.warnings += other.warnings
+		return self
+
+	def as_dict(self):
+		return {
+			"files_transferred": self.files_transferred,
+			"files_deleted": self.files_deleted,
+			"bytes_sent": self.bytes_sent,
+			"bytes_received": self.bytes_received,
+			"elapsed_sec": self.elapsed_sec,
+			"bytes_per_sec": self.bytes_per_sec,
+			"exit_code": self.exit_code,
+			"warnings": self.warnings,
+			"reconnects": self.reconnects,
+			"resumes": self.resumes,
+			"details": self.details,
+		}
+
+	def __repr__(self):
+		interruptions = f", {self.reconnects} reconnects, {self.resumes} resumes" if self.reconnects or self.resumes else ""
+		return (f"SyncResult({self.files_transferred} files transferred, {self.files_deleted} deleted, "
+			f"{self.bytes_sent} bytes sent, {self.bytes_received} received, in {self.elapsed_sec:.2f}s{interruptions})")
+
+def parse_progress_line(line, elapsed_sec):
+	""" Turn one --info=progress2 line into a progress event dict, or None if it isn't one. """
+	match = PROGRESS_RE.match(line)
+	if match is None:
+		return None
+	transferred, percent, rate, unit, _, xfr, to_check, total = match.groups()
+	percent = int(percent)
+	files_done = int(xfr) if xfr is not None else 0
+	return {
+		"bytes": int(transferred.replace(",", "")),
+		"percent": percent,
+		"bytes_per_sec": float(rate) * RATE_UNITS.get(unit, 1),
+		"files_per_sec": files_done / elapsed_sec if elapsed_sec > 0 else 0.0,
+		"files_done": files_done,
+		"files_to_check": int(to_check) if to_check is not None else None,
+		"eta_sec": elapsed_sec * (100 - percent) / percent if percent > 0 else None,
+		"elapsed_sec": elapsed_sec,
+	}
+
+def log_progress(event, _last=[0.0]):
+	""" The default progress callback, which logs at most about once a second. """
+	if time.time() - _last[0] < 1 and event["percent"] < 100:
+		return
+	_last[0] = time.time()
+	eta = f"{event['eta_sec']:.0f}s" if event["eta_sec"] is not None else "?"
+	LOGGER.opt(ansi=True).info(f"<light-blue>{event['percent']}%  {event['bytes_per_sec']/1e6:.2f} MB/s  {event['files_per_sec']:.1f} files/s  eta {eta}</light-blue>")
+
+def run_rsync(cmd, on_progress=None):
+	"""
+	Run an rsync command (a list of args), streaming its output as it's produced.
+	--info=progress2 and --stats are added, so overall progress can be passed to on_progress
+	(a callable taking an event dict) and the totals can be collected into a SyncResult.
+	Raises RsyncError for exit codes that mean the transfer failed.
+	"""
+	on_progress = on_progress or log_progress
+	cmd = cmd[:1] + ["--info=progress2", "--stats"] + cmd[1:]
+	result = SyncResult()
+	start_time = time.time()
+
+	process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+	# stderr is read on its own thread, so neither pipe can fill up and stall rsync
+	error_lines = []
+	def read_stderr():
+		for raw_line in process.stderr:
+			line = raw_line.decode("utf-8", errors="replace").rstrip()
+			if line:
+				error_lines.append(line)
+				LOGGER.error(f"rsync: {line}")
+	stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+	stderr_thread.start()
+
+	# progress lines end in \r rather than \n, so split on both
+	pending = b""
+	while True:
+		chunk = process.stdout.read1(65536)
+		if not chunk:
+			break
+		pending += chunk
+		*lines, pending = re.split(rb"[\r\n]", pending)
+		for raw_line in lines:
+			handle_output_line(raw_line.decode("utf-8", errors="replace"), result, start_time, on_progress)
+	handle_output_line(pending.decode("utf-8", errors="replace"), result, start_time, on_progress)
+
+	result.exit_code = process.wait()
+	stderr_thread.join()
+	result.elapsed_sec = time.time() - start_time
+
+	if result.exit_code in RSYNC_WARNING_EXIT_CODES:
+		result.warnings.append(RSYNC_EXIT_CODES[result.exit_code])
+		LOGGER.warning(f"rsync: {RSYNC_EXIT_CODES[result.exit_code]}")
+	elif result.exit_code != 0:
+		raise RsyncError(result.exit_code, error_lines)
+	return result
+
+def backoff_sec(attempt):
+	""" How long to wait before retry number attempt (from 0), doubling each time. """
+	return min(RETRY_BACKOFF_SEC * 2**attempt, MAX_BACKOFF_SEC)
+
+def run_rsync_resumable(cmd, on_progress=None, attempts=RSYNC_ATTEMPTS):
+	"""
+	Like run_rsync, but if the connection to the container breaks part way, waits (with backoff)
+	and runs it again. Files that already made it across are skipped by rsync's usual checks,
+	and partly sent ones are kept in PARTIAL_DIR, so they're continued rather than started over.
+	"""
+	cmd = cmd[:1] + [f"--partial-dir={PARTIAL_DIR}"] + cmd[1:]
+	result = SyncResult()
+	start_time = time.time()
+	for attempt in range(attempts):
+		try:
+			result.add(run_rsync(cmd, on_progress))
+			result.elapsed_sec = time.time() - start_time # including the interrupted attempts and waits
+			return result
+		except RsyncError as e:
+			if e.exit_code not in RSYNC_RESUMABLE_EXIT_CODES or attempt == attempts - 1:
+				raise
+			LOGGER.warning(f"{e}, resuming in {backoff_sec(attempt)}s (attempt {attempt + 2} of {attempts})")
+			time.sleep(backoff_sec(attempt))
+			result.resumes += 1
+
+def handle_output_line(line, result, start_time, on_progress):
+	if line.strip() == "":
+		return
+	event = parse_progress_line(line, time.time() - start_time)
+	if event is not None:
+		on_progress(event)
+		return
+	for name, regex in STATS_RE.items():
+		match = regex.match(line)
+		if match is not None:
+			setattr(result, name, int(match.group(1).replace(",", "")))
+			return
+	LOGGER.opt(ansi=True).info(f"<light-blue>{line}</light-blue>")
@@ -78,12 +78,20 @@ fi
 # incusdev.run_local_cmd(f"incus shell {incus_container_name} -- sh -c \"chown -R ubuntu:ubuntu {remote_working_dir}\"", print_cmd=True, print_result=True)		
 # huh! why does the command work below, but not when run as the line above, in python?
 #incus shell $container_incus_name -- sh -c "chown -R ubuntu:ubuntu $remote_working_dir"
-incus shell $container_incus_name -- sh -c "chown -R ubuntu:ubuntu /home/ubuntu/from_host/" # mod on 14apr23 as the parent folder/s seem to still have the src users UID (e..g 1002 vs 1000)
+# a shared folder (see 'incusdev shared_folder_attach') is the host's own files, so chowning it would change their owners on the host too
+shared_folder_attached=$(incus config device list $container_incus_name | grep -c '^incusdev-' || true)
+if [ "$shared_folder_attached" = "0" ]; then
+	incus shell $container_incus_name -- sh -c "chown -R ubuntu:ubuntu /home/ubuntu/from_host/" # mod on 14apr23 as the parent folder/s seem to still have the src users UID (e..g 1002 vs 1000)
+else
+	echo "A shared folder is attached to "$container_incus_name", leaving file owners alone"
+fi
 
 # copy over files
 (cd $gitrootdir; incusdev rsync_to_container $container delete)
 
-incus shell $container_incus_name -- sh -c "chown -R ubuntu:ubuntu $remote_working_dir"
+if [ "$shared_folder_attached" = "0" ]; then
+	incus shell $container_incus_name -- sh -c "chown -R ubuntu:ubuntu $remote_working_dir"
+fi
 
 
 # open program
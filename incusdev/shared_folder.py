@@ -0,0 +1,117 @@
+"""Share the host working directory with the container as an incus disk device, instead of copying it with rsync."""
+import os, json, time, shlex, shutil, hashlib
+
+from .log import LOGGER
+from .host import run_incus
+from .paths import remote_filename_from_local
+
+# devices are named after the host directory, so the same directory always gets the same device
+DEVICE_PREFIX = "incusdev-"
+
+# the container's ubuntu user, which shift=true only lines up with the host user if they have the same uid
+CONTAINER_UID = 1000
+
+# benchmark() works on a copy of the working directory, made next to it with this suffix
+SCRATCH_SUFFIX = "-incusdev-benchmark"
+
+def get_device_name(local_dir):
+	return DEVICE_PREFIX + hashlib.sha1(local_dir.encode("utf-8")).hexdigest()[:12]
+
+def get_devices(incus_container_name, incus_cmd="incus"):
+	""" The container's own devices (not those from its profiles), as {name: config}. """
+	return json.loads(run_incus(incus_cmd, "query", f"/1.0/instances/{incus_container_name}"))["devices"]
+
+def find_shared_folder(incus_container_name, local_dir, incus_cmd="incus"):
+	"""
+	The name of the disk device that shares local_dir with the container, or None.
+	A device for one of its parent directories counts too, as long as it's mounted where
+	remote_filename_from_local says, since then the paths inside line up the same way.
+	"""
+	for name, device in get_devices(incus_container_name, incus_cmd).items():
+		source = device.get("source", "").rstrip("/")
+		if device.get("type") != "disk" or source == "" or "home" not in source:
+			continue
+		if (local_dir == source or local_dir.startswith(source + "/")) and device.get("path") == remote_filename_from_local(source):
+			return name
+	return None
+
+def attach(incus_container_name, local_dir, incus_cmd="incus"):
+	"""
+	Mount local_dir in the container at the same path rsync would copy it to, with shift=true,
+	so file owners keep the same uids inside the container as on the host. The host user's
+	files only belong to the container's ubuntu user if the host user is uid 1000 too,
+	otherwise the container would need a raw.idmap mapping the host uid to 1000.
+	Does nothing if it's already shared.
+	"""
+	existing = find_shared_folder(incus_container_name, local_dir, incus_cmd)
+	if existing is not None:
+		LOGGER.info(f"{local_dir} is already shared with {incus_container_name} (device {existing})")
+		return existing
+
+	name = get_device_name(local_dir)
+	remote_dir = remote_filename_from_local(local_dir)
+	# anything rsync'd to remote_dir before is hidden under the mount, not deleted, and shows again on detach
+	run_incus(incus_cmd, "config", "device", "add", incus_container_name, name, "disk", f"source={local_dir}", f"path={remote_dir}", "shift=true")
+	LOGGER.info(f"Shared {local_dir} with {incus_container_name} at {remote_dir} (device {name})")
+	if os.getuid() != CONTAINER_UID:
+		LOGGER.warning(f"Your uid is {os.getuid()}, so the shared files belong to uid {os.getuid()} in the container rather than ubuntu ({CONTAINER_UID}), "
+			f"which may not be able to write to them. To map it, run: incus config set {incus_container_name} raw.idmap 'both {os.getuid()} {CONTAINER_UID}' and restart the container")
+	return name
+
+def detach(incus_container_name, local_dir, incus_cmd="incus"):
+	""" Remove the device that attach() added for local_dir. Does nothing if there isn't one. """
+	name = get_device_name(local_dir)
+	if name not in get_devices(incus_container_name, incus_cmd):
+		LOGGER.info(f"{local_dir} isn't shared with {incus_container_name}")
+		return False
+	run_incus(incus_cmd, "config", "device", "remove", incus_container_name, name)
+	LOGGER.info(f"Stopped sharing {local_dir} with {incus_container_name}")
+	return True
+
+def benchmark(client, build_command, repeats=1):
+	"""
+	Time a build in the container both ways: rsync to the container, build, then rsync back,
+	against building straight in the shared folder. It's all done on a scratch copy of the
+	working directory, next to it so it maps into the container the same way, so neither
+	the host's files nor any work in the container that hasn't been copied back are touched.
+	Returns {"rsync": [seconds per run], "shared_folder": [seconds per run]}.
+	"""
+	container, local_dir = client.incus_container_name, client.local_working_directory
+	scratch_dir = local_dir.rstrip("/") + SCRATCH_SUFFIX
+	assert not os.path.exists(scratch_dir), f"{scratch_dir} already exists (left by an interrupted benchmark?), remove it first"
+	existing = find_shared_folder(container, scratch_dir)
+	assert existing is None, f"A copy next to {local_dir} would be shared through the device {existing} for a parent directory, so there'd be nothing to rsync, detach that first"
+	timings = {"rsync": [], "shared_folder": []}
+
+	def build():
+		client.execute_batch([build_command], within_remote_working_dir=True, raise_on_failure=True)
+
+	shutil.copytree(local_dir, scratch_dir, symlinks=True)
+	remote_scratch_dir = remote_filename_from_local(scratch_dir)
+	original = (client.local_working_directory, client.remote_working_directory, client.shared_folder)
+	client.local_working_directory, client.remote_working_directory, client.shared_folder = scratch_dir, remote_scratch_dir, None
+	try:
+		for i in range(repeats):
+			start_time = time.time()
+			client.rsync_to_container(delete=True) # only ever the scratch copy
+			build()
+			client.rsync_from_container(delete=True)
+			timings["rsync"].append(time.time() - start_time)
+
+		attach(container, scratch_dir)
+		client.shared_folder = None # forget the cached lookup, as it's changing under the client
+		for i in range(repeats):
+			start_time = time.time()
+			build()
+			timings["shared_folder"].append(time.time() - start_time)
+	finally:
+		client.local_working_directory, client.remote_working_directory, client.shared_folder = original
+		detach(container, scratch_dir)
+		# detached first, so this only removes the container's own copy
+		client.execute_commands(f"rm -rf {shlex.quote(remote_scratch_dir)}", ignore_failures=True)
+		shutil.rmtree(scratch_dir)
+
+	for mode, times in timings.items():
+		if times:
+			LOGGER.info(f"{mode}: best {min(times):.2f}s, average {sum(times)/len(times):.2f}s over {len(times)} runs")
+	return timings
@@ -1,4 +1,4 @@
-import os, argparse
+import os, sys, json, time, shlex, argparse, subprocess, contextlib
 import incusdev
 import textwrap
 
@@ -6,7 +6,11 @@ defined_tasks = [
 	"check_dirs",
 	"rsync_to_container",
 	"rsync_from_container",
+	"git_sync_to_container", # like rsync_to_container, but uses git's index to only send what changed
+	"git_sync_submodules_to_container", # like git_sync_to_container, but syncs each submodule separately and concurrently
+	"pull_artifacts", # copy back only files matching globs, e.g. incusdev pull_artifacts incus_doc-dev "Outputs/**/*.bit"
 	"get_remote_working_directory",
+	"check_startup_time", # fail if importing the cli has become slow, or pulls in paramiko/loguru up front
 
 	"init_incus_git-server_on_host",
 	"init_incus_git-server_access_in_container",
@@ -18,7 +22,25 @@ defined_tasks = [
 	"open_local_workingdir_from_git_url_for",
 
 	"open_workspace_in",
-	"run_program_in"
+	"run_program_in",
+
+	# several sync/exec/pull steps over one connection, from a pipeline file or a line like
+	# incusdev run_pipeline incus_doc-dev "sync delete -> exec make -j8 -> pull Outputs/**/*.bit"
+	# with 'repeat' as arg3, it runs again each time enter is pressed, reusing the connection
+	"run_pipeline",
+
+	# mount the working directory in the container instead of copying it, after which the
+	# sync tasks do nothing, e.g. incusdev shared_folder_attach incus_doc-dev $(pwd)
+	"shared_folder_attach",
+	"shared_folder_detach",
+	# time a build both ways, e.g. incusdev benchmark_shared_folder incus_doc-dev $(pwd) "make -j8" 3
+	"benchmark_shared_folder",
+
+	# a warm pool of ephemeral clones of a template container, so run_program_in_pool
+	# doesn't wait for a container to boot or for the initial sync
+	"pool_fill",
+	"pool_drain",
+	"run_program_in_pool",
 ]
 
 def main():
@@ -29,9 +51,15 @@ def main():
 	parser.add_argument("arg3", type=str, nargs='?', help="arg3", default="")
 	parser.add_argument("arg4", type=str, nargs='?', help="arg4", default="")
 	# parser.add_argument("script_dir", type=str, nargs='?', default="none")
+	parser.add_argument("--json", action="store_true", help="print progress and results as json lines on stdout (logs go to stderr)")
+	parser.add_argument("--telemetry", action="store_true", help="sample the container's cpu/memory/disk/network use during open_workspace_in and run_program_in sessions")
+	parser.add_argument("--telemetry-interval", type=float, default=2.0, help="seconds between telemetry samples")
 
 	args = parser.parse_args()
 
+	if args.json:
+		incusdev.log.create_logger(sys.stderr)
+
 	assert args.task in defined_tasks
 
 	if args.task == "check_dirs":
@@ -40,6 +68,16 @@ def main():
 		print(f"User dir is: {os.path.expanduser('~')}")
 		print(f"Script called from {os.getcwd()}")
 
+	elif args.task == "get_remote_working_directory":
+		# only a path calculation, so there's no need to check or connect to the container.
+		# this 'print' is used to save the result as a variable in some bash scripts, 
+		# e.g. remote_dir=$(incusdev get_remote_working_directory incus_doc-dev keep)
+		assert "home" in os.getcwd(), "this function is defined for folders within a host users home directory only"
+		print(incusdev.paths.remote_filename_from_local(os.getcwd()), end="")
+
+	elif args.task == "check_startup_time":
+		check_startup_time()
+
 	elif args.task == "init_incus_git-server_on_host": 
 		init_incus_git_server_on_host(args)
 	
@@ -49,7 +87,7 @@ def main():
 	elif args.task == "open_local_workingdir_from_git_url_for":
 		open_local_workingdir_from_git_url_for(args)
 
-	elif args.task in ["rsync_to_container", "rsync_from_container", "get_remote_working_directory"]:
+	elif args.task in ["rsync_to_container", "rsync_from_container", "git_sync_to_container", "git_sync_submodules_to_container", "pull_artifacts"]:
 		do_rsync(args)
 
 	elif args.task == "open_workspace_in":
@@ -57,6 +95,15 @@ def main():
 	
 	elif args.task == "run_program_in":
 		run_program_in(args)
+
+	elif args.task == "run_pipeline":
+		run_pipeline(args)
+
+	elif args.task in ["shared_folder_attach", "shared_folder_detach", "benchmark_shared_folder"]:
+		use_shared_folder(args)
+
+	elif args.task in ["pool_fill", "pool_drain", "run_program_in_pool"]:
+		use_pool(args)
 		
 	else:
 		assert 0, "Invalid task given"
@@ -105,47 +152,36 @@ def init_incus_git_server_access_in_container(args):
 		local_working_directory = os.getcwd() # the directory where this is called from
 		) as ssh_remote_client:
 			
-			_, error = ssh_remote_client.execute_commands("cat ~/.ssh/id_rsa.pub > /dev/null", get_stderr=True)
-			for line in error:
-				if "No such file or directory" in line: # then we need to set up a key
-					# from https://unix.stackexchange.com/questions/69314/automated-ssh-keygen-without-passphrase-how
-					ssh_remote_client.execute_commands('< /dev/zero ssh-keygen -q -N "" > /dev/null')
-			dev_container_key = "".join(ssh_remote_client.execute_commands("cat ~/.ssh/id_rsa.pub"))
-
-			# also add the name resolution from 'incus_git-server' to ipaddress
-			result, error = ssh_remote_client.execute_commands("touch ~/.ssh/config && cat ~/.ssh/config", get_stderr=True) # touch in case it doesn't exist
-			assert error == []
-			found = False
-			for line in result:
-				if "incus_git-server" in line:
-					found = True
-			if not found:
-				name_resolution_lines = textwrap.dedent(""" 
-				Host incus_git-server
-					HostName 10.40.119.159
-					User ubuntu
-					IdentityFile ~/.ssh/id_rsa
-					ForwardAgent Yes
-					ForwardX11 Yes
-
-				""")
-				for line in name_resolution_lines.split("\n"):
-					ssh_remote_client.execute_commands(f"echo '{line}' >> ~/.ssh/config")
-			
+			name_resolution_lines = textwrap.dedent(""" 
+			Host incus_git-server
+				HostName 10.40.119.159
+				User ubuntu
+				IdentityFile ~/.ssh/id_rsa
+				ForwardAgent Yes
+				ForwardX11 Yes
+
+			""")
+			quoted_config_lines = " ".join(shlex.quote(line) for line in name_resolution_lines.split("\n"))
+
+			# all in one round trip:
+			# make a key if there isn't one (from https://unix.stackexchange.com/questions/69314/automated-ssh-keygen-without-passphrase-how),
+			# get the public key, and add the name resolution from 'incus_git-server' to ipaddress if it's not there yet
+			key_result, config_result = ssh_remote_client.execute_batch([
+				'(test -f ~/.ssh/id_rsa.pub || < /dev/zero ssh-keygen -q -N "" > /dev/null) && cat ~/.ssh/id_rsa.pub',
+				f"touch ~/.ssh/config && (grep -q incus_git-server ~/.ssh/config || printf '%s\\n' {quoted_config_lines} >> ~/.ssh/config)",
+			], raise_on_failure=True)
+			dev_container_key = "".join(key_result.stdout)
+
 	# now let's copy the public key to the known keys of incus_git-server, using the default location
 	with incusdev.RemoteClient(
 		host = "incus_git-server",
 		incus_container_name = "git-server",
 		local_working_directory = os.getcwd() # the directory where this is called from
 		) as ssh_remote_client:
-			# first, check that we haven't already got this key in the destination file
-			contains_key = False
-			for key_to_check in ssh_remote_client.execute_commands('cat ~/.ssh/authorized_keys'):
-				if dev_container_key in key_to_check:
-					contains_key = True
-			
-			if not contains_key:
-				ssh_remote_client.execute_commands(f"echo {dev_container_key} >> ~/.ssh/authorized_keys")
+			# only add the key if it's not already in the destination file
+			ssh_remote_client.execute_batch([
+				f"grep -qxF {shlex.quote(dev_container_key)} ~/.ssh/authorized_keys || echo {shlex.quote(dev_container_key)} >> ~/.ssh/authorized_keys"
+			], raise_on_failure=True)
 	
 	# now the dev container has ssh access to the incus_git-server container
 	# set up the dev container's git worktree, if not set up yet
@@ -160,22 +196,17 @@ def init_incus_git_server_access_in_container(args):
 			desired_remote_git_path = ssh_remote_client.get_remote_filename_from_local(local_git_path[0])
 			print(desired_remote_git_path)
 
-			result = ssh_remote_client.execute_commands(f"git -C {desired_remote_git_path} status")
-			for line in result:
-				if "not a git repository" in line:
-					# then we need to make the repo
-					ssh_remote_client.execute_commands([f"git -C {desired_remote_git_path} init"])
-			
-			result = ssh_remote_client.execute_commands(f"git -C {desired_remote_git_path} remote -v | grep incus_git-server")
-			
-			if result == []: # then we haven't yet added the new remote
-				ssh_remote_client.execute_commands(f"git -C {desired_remote_git_path} remote add incus_git-server incus_git-server:{desired_remote_git_path}.git")
-
 			# also make sure the dev container's git name and email, for this repo, matches the host
 			host_git_repo_user_name = incusdev.run_local_cmd("git config user.name")[0][0]
 			host_git_repo_user_email = incusdev.run_local_cmd("git config user.email")[0][0]
-			ssh_remote_client.execute_commands(f"git -C {desired_remote_git_path} config user.name {host_git_repo_user_name}")
-			ssh_remote_client.execute_commands(f"git -C {desired_remote_git_path} config user.email {host_git_repo_user_email}")
+
+			# make the repo and add the new remote if they're not there yet, then set the name and email, in one round trip
+			ssh_remote_client.execute_batch([
+				f"test -d {desired_remote_git_path}/.git || git -C {desired_remote_git_path} init",
+				f"git -C {desired_remote_git_path} remote get-url incus_git-server > /dev/null 2>&1 || git -C {desired_remote_git_path} remote add incus_git-server incus_git-server:{desired_remote_git_path}.git",
+				f"git -C {desired_remote_git_path} config user.name {shlex.quote(host_git_repo_user_name)}",
+				f"git -C {desired_remote_git_path} config user.email {shlex.quote(host_git_repo_user_email)}",
+			], stop_on_failure=True, raise_on_failure=True)
 
 	""" 
 	How to deal with this interactive situation?
@@ -228,7 +259,7 @@ def do_rsync(args):
 		
 	incus_container_name = assert_we_can_extract_incus_name_from_hostname(args.remote_hostname)
 
-	if args.task in ["rsync_to_container", "rsync_from_container"]:
+	if args.task in ["rsync_to_container", "rsync_from_container", "git_sync_to_container", "git_sync_submodules_to_container"]:
 		if args.arg2 == "":
 			delete = False
 		elif args.arg2 == "delete":
@@ -261,20 +292,56 @@ def do_rsync(args):
 		) as ssh_remote_client:
 			# print("Connected!")
 
+			on_progress = print_json_event("progress") if args.json else None
+
 			if args.task == "rsync_to_container":
-				ssh_remote_client.rsync_to_container(delete=delete)
+				result = ssh_remote_client.rsync_to_container(delete=delete, on_progress=on_progress)
 
 			elif args.task == "rsync_from_container":
-				ssh_remote_client.rsync_from_container(delete=delete)
+				result = ssh_remote_client.rsync_from_container(delete=delete, on_progress=on_progress)
+
+			elif args.task == "git_sync_to_container":
+				result = ssh_remote_client.git_sync_to_container(delete=delete, on_progress=on_progress)
+
+			elif args.task == "git_sync_submodules_to_container":
+				result = ssh_remote_client.git_sync_submodules_to_container(delete=delete, on_progress=on_progress)
 
-			elif args.task == "get_remote_working_directory":
-				print(ssh_remote_client.remote_working_directory, end="") 
-				# this 'print' is used to save the result as a variable in some bash scripts, 
-				# e.g. remote_dir=$(incusdev get_remote_working_directory incus_doc-dev keep)
+			elif args.task == "pull_artifacts":
+				# arg2 holds the glob patterns, space separated
+				result = ssh_remote_client.pull_artifacts(shlex.split(args.arg2))
 
 			else:
 				assert 0	
 
+			if args.json:
+				print_json_event("result")(result.as_dict())
+
+# the cli's own import time budget, and modules that shouldn't be imported until a task needs them
+STARTUP_BUDGET_SEC = 0.05
+HEAVY_MODULES = ["paramiko", "loguru"]
+
+def check_startup_time():
+	# measured in a fresh interpreter with -X importtime, so nothing is already cached in sys.modules
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import incusdev.standalone_cli"], stderr=subprocess.PIPE, check=True)
+	# lines look like 'import time:       412 |      20451 | incusdev.standalone_cli', in microseconds
+	imported = {}
+	for line in result.stderr.decode("utf-8").split("\n"):
+		fields = [f.strip() for f in line.replace("import time:", "").split("|")]
+		if len(fields) == 3 and fields[1].isdigit():
+			imported[fields[2]] = int(fields[1]) / 1e6
+
+	total_sec = imported.get("incusdev.standalone_cli", 0.0)
+	heavy = [m for m in HEAVY_MODULES if m in imported]
+	print(f"incusdev.standalone_cli imports in {total_sec*1000:.1f} ms (budget {STARTUP_BUDGET_SEC*1000:.0f} ms)")
+	assert heavy == [], f"Imported up front, but should be lazy: {heavy}"
+	assert total_sec <= STARTUP_BUDGET_SEC, f"Import time of {total_sec*1000:.1f} ms is over budget"
+
+def print_json_event(event_name):
+	""" Make a callback that prints each dict it's given as one json line, tagged with event_name. """
+	def print_event(content):
+		print(json.dumps(dict(content, event=event_name)), flush=True)
+	return print_event
+
 def open_workspace_in(args):
 	# this is to replace having complexity in the `open_workspace_in_xxx.sh` files
 	assert "home" in os.getcwd(), "this function is defined for folders within a host users home directory only"
@@ -296,7 +363,8 @@ def open_workspace_in(args):
 	# as it currently works in a .sh file, just use that, for now
 	script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "open_workspace_in_container.sh")
 
-	incusdev.run_local_gui_cmd(f"{script_path} {host} {local_working_dir} {remote_working_dir} {incus_container_name}")
+	with session_telemetry(args, incus_container_name):
+		incusdev.run_local_gui_cmd(f"{script_path} {host} {local_working_dir} {remote_working_dir} {incus_container_name}")
 
 def run_program_in(args):
 	# this was made in order to more easily run programs in wine in a container
@@ -322,9 +390,110 @@ def run_program_in(args):
 	
 	script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "run_program_in_container.sh")
 	
-	incusdev.run_local_gui_cmd(f"{script_path} {host} {local_working_dir} {remote_working_dir} {incus_container_name} {programname} {arguments}")
+	with session_telemetry(args, incus_container_name):
+		incusdev.run_local_gui_cmd(f"{script_path} {host} {local_working_dir} {remote_working_dir} {incus_container_name} {programname} {arguments}")
+
+def run_pipeline(args):
+	assert "home" in os.getcwd(), "this function is defined for folders within a host users home directory only"
+	assert args.arg2 != "", "Give a pipeline file, or steps like \"sync -> exec make -> pull Outputs/*\""
+	assert args.arg3 in ["", "repeat"], "Invalid arg3 argument passed, should be 'repeat' or nothing"
 
+	from incusdev import pipeline
+	steps = pipeline.load_pipeline_file(args.arg2) if os.path.isfile(args.arg2) else pipeline.parse_inline(args.arg2)
+	pipeline.check_steps(steps) # before connecting, so mistakes show up straight away
+
+	incus_container_name = assert_we_can_extract_incus_name_from_hostname(args.remote_hostname)
+	with incusdev.RemoteClient(
+		host = args.remote_hostname, # e.g. incus_doc-dev
+		incus_container_name = incus_container_name,
+		local_working_directory = os.getcwd() # the directory where this is called from
+		) as ssh_remote_client:
+			while True:
+				start_time = time.time()
+				results = pipeline.run_pipeline(ssh_remote_client, steps,
+					on_step=print_json_event("step") if args.json else None,
+					on_progress=print_json_event("progress") if args.json else None)
+
+				incusdev.LOGGER.info(f"Pipeline finished in {time.time() - start_time:.2f}s")
+				for result in results:
+					incusdev.LOGGER.info(f"  {result.name}: {result.status}, {result.elapsed_sec:.2f}s")
+				succeeded = all(result.status == "ok" for result in results)
+
+				if args.arg3 != "repeat":
+					break
+				try:
+					input("Press enter to run the pipeline again (ctrl-d to stop) ")
+				except EOFError:
+					break
+
+	if not succeeded:
+		sys.exit(1)
+
+def use_shared_folder(args):
+	# incusdev shared_folder_attach <container> <workingdir>
+	# incusdev shared_folder_detach <container> <workingdir>
+	# incusdev benchmark_shared_folder <container> <workingdir> <build command> <repeats>
+	assert "home" in os.getcwd(), "this function is defined for folders within a host users home directory only"
+
+	incus_container_name = assert_we_can_extract_incus_name_from_hostname(args.remote_hostname)
+	local_working_dir = os.path.abspath(args.arg2) if args.arg2 != "" else os.getcwd()
+
+	if args.task == "shared_folder_attach":
+		incusdev.shared_folder.attach(incus_container_name, local_working_dir)
+
+	elif args.task == "shared_folder_detach":
+		incusdev.shared_folder.detach(incus_container_name, local_working_dir)
+
+	elif args.task == "benchmark_shared_folder":
+		assert args.arg3 != "", "Give the build command to time"
+		repeats = int(args.arg4) if args.arg4 != "" else 1
+		with incusdev.RemoteClient(
+			host = args.remote_hostname, # e.g. incus_doc-dev
+			incus_container_name = incus_container_name,
+			local_working_directory = local_working_dir
+			) as ssh_remote_client:
+				timings = incusdev.shared_folder.benchmark(ssh_remote_client, args.arg3, repeats)
+		if args.json:
+			print_json_event("result")(timings)
+
+def session_telemetry(args, incus_container_name):
+	# sampling happens on a background thread, and the summary is logged when the session ends
+	if not args.telemetry:
+		return contextlib.nullcontext()
+	return incusdev.TelemetryCollector(incus_container_name, interval_sec=args.telemetry_interval)
+
+
+def use_pool(args):
+	# syntax:
+	# incusdev pool_fill <template-container> <workingdir> <size>
+	# incusdev pool_drain <template-container> <workingdir>
+	# incusdev run_program_in_pool <template-container> <workingdir> <programname> <arguments>
+	# the template container needs whatever profile lets GUI programs reach the host display,
+	# as pool containers are reached over 'incus exec' rather than ssh with X forwarding
+	assert "home" in os.getcwd(), "this function is defined for folders within a host users home directory only"
+
+	incus_container_name = assert_we_can_extract_incus_name_from_hostname(args.remote_hostname)
+	local_working_dir = os.path.abspath(args.arg2)
 
+	if args.task == "pool_fill":
+		size = int(args.arg3) if args.arg3 != "" else 2
+		with incusdev.ContainerPool(incus_container_name, local_working_dir, size=size) as pool:
+			if pool.get_snapshot() is None:
+				pool.prepare_template()
+			pool.refill()
+
+	elif args.task == "pool_drain":
+		incusdev.ContainerPool(incus_container_name, local_working_dir).drain()
+
+	elif args.task == "run_program_in_pool":
+		with incusdev.ContainerPool(incus_container_name, local_working_dir) as pool:
+			name = pool.acquire() # the pool is topped back up in the background while the program runs
+			try:
+				with session_telemetry(args, name):
+					pool.run_program(name, args.arg3, args.arg4)
+				pool.sync_out_of(name)
+			finally:
+				pool.release(name)
 
 def assert_we_can_extract_incus_name_from_hostname(hostname):
 	incus_container_name = hostname.replace("incus_", "") # e.g. incus_doc-dev -> doc-dev
@@ -0,0 +1,178 @@
+"""Sample a container's cpu, memory, disk io and network use in the background, while a session runs."""
+import os, json, time, shlex, threading, subprocess
+
+from .log import LOGGER
+
+# incus puts each container in its own cgroup (v2) on the host
+CGROUP_PATH = "/sys/fs/cgroup/lxc.payload.{name}"
+
+COLUMNS = ["time_sec", "cpu_percent", "memory_bytes", "disk_read_bytes_per_sec", "disk_write_bytes_per_sec", "net_rx_bytes_per_sec", "net_tx_bytes_per_sec"]
+
+class CachedFile:
+	""" A file that's opened once and re-read from the start each time, e.g. a cgroup or sysfs counter. """
+
+	def __init__(self, path):
+		self.fd = os.open(path, os.O_RDONLY)
+
+	def read(self):
+		return os.pread(self.fd, 65536, 0).decode("utf-8")
+
+	def close(self):
+		os.close(self.fd)
+
+class CgroupSource:
+	"""
+	Reads counters straight from the container's cgroup files and its host side network
+	interface, through handles that stay open, so each sample is a few pread calls.
+	"""
+
+	def __init__(self, incus_container_name, host_interfaces):
+		cgroup = CGROUP_PATH.format(name=incus_container_name)
+		self.cpu = CachedFile(os.path.join(cgroup, "cpu.stat"))
+		self.memory = CachedFile(os.path.join(cgroup, "memory.current"))
+		self.io = CachedFile(os.path.join(cgroup, "io.stat"))
+		# the host end of a veth pair sees the container's sends as received, and vice versa
+		self.net = [(CachedFile(f"/sys/class/net/{i}/statistics/tx_bytes"), CachedFile(f"/sys/class/net/{i}/statistics/rx_bytes")) for i in host_interfaces]
+
+	def read(self):
+		cpu_usec = 0
+		for line in self.cpu.read().split("\n"):
+			if line.startswith("usage_usec "):
+				cpu_usec = int(line.split()[1])
+		read_bytes = write_bytes = 0
+		for line in self.io.read().split("\n"):
+			for field in line.split()[1:]:
+				key, _, value = field.partition("=")
+				if key == "rbytes":
+					read_bytes += int(value)
+				elif key == "wbytes":
+					write_bytes += int(value)
+		return {
+			"cpu_sec": cpu_usec / 1e6,
+			"memory_bytes": int(self.memory.read()),
+			"disk_read_bytes": read_bytes,
+			"disk_write_bytes": write_bytes,
+			"net_rx_bytes": sum(int(rx.read()) for rx, _ in self.net),
+			"net_tx_bytes": sum(int(tx.read()) for _, tx in self.net),
+		}
+
+	def close(self):
+		for f in [self.cpu, self.memory, self.io] + [f for pair in self.net for f in pair]:
+			f.close()
+
+class IncusStateSource:
+	""" Falls back to 'incus query' of the instance state, for when the cgroup files can't be read (e.g. a remote incus). """
+
+	def __init__(self, incus_container_name, incus_cmd="incus"):
+		self.cmd = shlex.split(incus_cmd) + ["query", f"/1.0/instances/{incus_container_name}/state"]
+
+	def read(self):
+		state = json.loads(subprocess.check_output(self.cmd))
+		networks = [n for name, n in (state.get("network") or {}).items() if name != "lo"]
+		return {
+			"cpu_sec": state["cpu"]["usage"] / 1e9,
+			"memory_bytes": state["memory"]["usage"],
+			"disk_read_bytes": None, # not part of the instance state
+			"disk_write_bytes": None,
+			"net_rx_bytes": sum(n["counters"]["bytes_received"] for n in networks),
+			"net_tx_bytes": sum(n["counters"]["bytes_sent"] for n in networks),
+		}
+
+	def close(self):
+		pass
+
+class TelemetryCollector:
+	"""
+	Samples a container every interval_sec on a background thread, appending a row of rates
+	to a csv file, then logs peak and average use when stopped. Use as a context manager
+	around a session, e.g. while a program runs in the container.
+	"""
+
+	def __init__(self, incus_container_name, interval_sec=2.0, output_path=None, incus_cmd="incus"):
+		self.incus_container_name = incus_container_name
+		self.interval_sec = interval_sec
+		self.incus_cmd = incus_cmd
+		self.output_path = output_path or os.path.expanduser(
+			f"~/.cache/incusdev/telemetry/{incus_container_name}-{time.strftime('%Y%m%d-%H%M%S')}.csv")
+		self.rows = []
+		self._stop = threading.Event()
+		self._thread = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def open_source(self):
+		try:
+			state = json.loads(subprocess.check_output(shlex.split(self.incus_cmd) + ["query", f"/1.0/instances/{self.incus_container_name}/state"]))
+			host_interfaces = [n["host_name"] for name, n in (state.get("network") or {}).items() if n.get("host_name")]
+			return CgroupSource(self.incus_container_name, host_interfaces)
+		except (OSError, ValueError, KeyError, subprocess.CalledProcessError):
+			return IncusStateSource(self.incus_container_name, self.incus_cmd)
+
+	def start(self):
+		self.source = self.open_source()
+		os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+		self.output_file = open(self.output_path, "w", buffering=1) # line buffered, so a crash still leaves the samples so far
+		self.output_file.write(",".join(COLUMNS) + "\n")
+		self._thread = threading.Thread(target=self.run, daemon=True)
+		self._thread.start()
+
+	def read_sample(self):
+		""" The source's next sample, or None if it can't be read any more. """
+		try:
+			return self.source.read()
+		except (OSError, ValueError, subprocess.CalledProcessError) as e:
+			LOGGER.warning(f"Stopped sampling {self.incus_container_name}: {e}") # e.g. the container was stopped
+			return None
+
+	def run(self):
+		start_time = time.monotonic()
+		last_time, last = start_time, self.read_sample()
+		while last is not None and not self._stop.wait(self.interval_sec):
+			now, sample = time.monotonic(), self.read_sample()
+			if sample is None:
+				break
+			elapsed = now - last_time
+
+			def rate(key):
+				if sample[key] is None:
+					return None
+				return (sample[key] - last[key]) / elapsed
+
+			row = [
+				now - start_time,
+				100 * (sample["cpu_sec"] - last["cpu_sec"]) / elapsed, # over 100 when using more than one core
+				sample["memory_bytes"],
+				rate("disk_read_bytes"),
+				rate("disk_write_bytes"),
+				rate("net_rx_bytes"),
+				rate("net_tx_bytes"),
+			]
+			self.rows.append(row)
+			self.output_file.write(",".join("" if x is None else f"{x:.6g}" for x in row) + "\n")
+			last_time, last = now, sample
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+		self.source.close()
+		self.output_file.close()
+		summary = self.summary()
+		LOGGER.info(f"Telemetry for {self.incus_container_name} saved to {self.output_path}")
+		for column, (peak, average) in summary.items():
+			LOGGER.info(f"  {column}: peak {peak:.6g}, average {average:.6g}")
+		return summary
+
+	def summary(self):
+		""" {column: (peak, average)} over the session, for columns that were measured. """
+		summary = {}
+		for i, column in enumerate(COLUMNS[1:], start=1):
+			values = [row[i] for row in self.rows if row[i] is not None]
+			if values:
+				summary[column] = (max(values), sum(values) / len(values))
+		return summary
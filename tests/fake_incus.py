@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the incus binary, for testing ContainerPool without real containers.
+Instances are kept in a json file (FAKE_INCUS_STATE), and FAKE_INCUS_DELAY adds a
+pause to every command, to make races between processes easier to hit.
+Only the subcommands the pool uses are handled, and 'exec' always succeeds.
+"""
+import os, sys, json, time, fcntl
+
+def main(args):
+	state_path = os.environ["FAKE_INCUS_STATE"]
+	time.sleep(float(os.environ.get("FAKE_INCUS_DELAY", "0")))
+
+	with open(state_path + ".lock", "a") as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX) # each command is atomic, like a real incus daemon call
+		try:
+			with open(state_path) as f:
+				instances = json.load(f)
+		except (OSError, ValueError):
+			instances = {}
+
+		code = run(instances, args)
+
+		with open(state_path, "w") as f:
+			json.dump(instances, f)
+	return code
+
+def run(instances, args):
+	command = args[0]
+	if command == "list":
+		print(json.dumps([{"name": name, "config": instance["config"]} for name, instance in instances.items()]))
+	elif command == "config" and args[1] == "get":
+		print(instances[args[2]]["config"].get(args[3], ""))
+	elif command == "config" and args[1] == "set":
+		key, _, value = args[3].partition("=")
+		instances[args[2]]["config"][key] = value
+	elif command == "copy":
+		config = {}
+		for i, arg in enumerate(args):
+			if arg == "--config":
+				key, _, value = args[i + 1].partition("=")
+				config[key] = value
+		instances[args[2]] = {"config": config, "ephemeral": "--ephemeral" in args}
+	elif command == "snapshot":
+		pass
+	elif command == "delete":
+		instances.pop(args[-1], None)
+	elif command in ["start", "exec"]:
+		if args[1] not in instances:
+			sys.stderr.write(f"Error: Instance not found\n")
+			return 1
+	else:
+		sys.stderr.write(f"fake incus doesn't handle: {args}\n")
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
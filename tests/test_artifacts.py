@@ -0,0 +1,128 @@
+import os, subprocess
+
+import pytest
+
+from incusdev import artifacts
+
+class LocalFile:
+	""" Enough of paramiko's SFTPFile, reading from the local filesystem. """
+
+	def __init__(self, path):
+		self.f = open(path, "rb")
+
+	def readv(self, chunks):
+		for offset, length in chunks:
+			self.f.seek(offset)
+			yield self.f.read(length)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.f.close()
+
+class LocalSFTP:
+	def __init__(self, fail_after=None):
+		self.fail_after = fail_after
+
+	def open(self, path, mode):
+		if self.fail_after is not None:
+			self.fail_after[0] -= 1
+			if self.fail_after[0] < 0:
+				raise EOFError("connection lost")
+		return LocalFile(path)
+
+	def close(self):
+		pass
+
+class Output:
+	def __init__(self, data, code):
+		self.data = data
+		self.channel = self
+		self.code = code
+
+	def read(self):
+		return self.data
+
+	def recv_exit_status(self):
+		return self.code
+
+class LocalSSHClient:
+	""" Runs commands and sftp reads on this machine instead of in a container. """
+
+	def __init__(self, fail_after=None):
+		self.fail_after = fail_after
+
+	def exec_command(self, command):
+		result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		return None, Output(result.stdout, result.returncode), Output(result.stderr, result.returncode)
+
+	def open_sftp(self):
+		return LocalSFTP(self.fail_after)
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+	monkeypatch.setenv("HOME", str(tmp_path)) # for checkpoints
+	remote_dir, local_dir = tmp_path / "remote", tmp_path / "local"
+	remote_dir.mkdir()
+	local_dir.mkdir()
+	return str(remote_dir), str(local_dir)
+
+def write(path, content):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "wb") as f:
+		f.write(content)
+
+def test_globs_are_quoted_apart_from_glob_characters(dirs):
+	remote_dir, local_dir = dirs
+	for name in ["out/a b.bit", "out/$(touch pwned).bit", "out/c.log", "x;y"]:
+		write(os.path.join(remote_dir, name), b"x")
+
+	files = artifacts.resolve_remote_globs(LocalSSHClient(), remote_dir, ["out/*.bit", "x;y", "$(touch pwned2)"])
+	assert [f[0] for f in files] == ["out/$(touch pwned).bit", "out/a b.bit", "x;y"]
+	assert not os.path.exists(os.path.join(remote_dir, "pwned2"))
+
+def test_pull_files_in_chunks_and_more_files_than_workers(dirs):
+	remote_dir, local_dir = dirs
+	contents = {f"out/{i}.bin": os.urandom(i * 3000) for i in range(20)}
+	for name, content in contents.items():
+		write(os.path.join(remote_dir, name), content)
+
+	files = artifacts.resolve_remote_globs(LocalSSHClient(), remote_dir, ["out"])
+	artifacts.pull_files(LocalSSHClient(), remote_dir, local_dir, files, workers=3, chunk_bytes=16384, request_bytes=1000)
+	for name, content in contents.items():
+		with open(os.path.join(local_dir, name), "rb") as f:
+			assert f.read() == content
+	assert not [name for name in os.listdir(os.path.join(local_dir, "out")) if name.endswith(artifacts.PART_SUFFIX)]
+
+def test_interrupted_pull_keeps_local_copies_and_resumes(dirs):
+	remote_dir, local_dir = dirs
+	content = os.urandom(100000)
+	write(os.path.join(remote_dir, "big.bin"), content)
+	write(os.path.join(local_dir, "big.bin"), b"the old copy")
+	files = artifacts.resolve_remote_globs(LocalSSHClient(), remote_dir, ["big.bin"])
+	checkpoint_path = artifacts.get_checkpoint_path(remote_dir, local_dir)
+
+	with pytest.raises(EOFError):
+		artifacts.pull_files(LocalSSHClient(fail_after=[2]), remote_dir, local_dir, files, workers=1, chunk_bytes=16384, checkpoint_path=checkpoint_path)
+	with open(os.path.join(local_dir, "big.bin"), "rb") as f:
+		assert f.read() == b"the old copy"
+
+	result = artifacts.pull_files(LocalSSHClient(), remote_dir, local_dir, files, workers=1, chunk_bytes=16384, checkpoint_path=checkpoint_path)
+	assert result.details["resumed_chunks"] == 2
+	with open(os.path.join(local_dir, "big.bin"), "rb") as f:
+		assert f.read() == content
+	assert not os.path.exists(checkpoint_path)
+
+@pytest.mark.parametrize("absolute", [False, True])
+def test_globs_outside_the_working_directory_are_refused(dirs, absolute):
+	remote_dir, local_dir = dirs
+	outside = os.path.join(os.path.dirname(remote_dir), "outside")
+	write(os.path.join(outside, "x.bit"), b"x")
+
+	pattern = os.path.join(outside, "*.bit") if absolute else "../outside/*.bit"
+	with pytest.raises(RuntimeError, match="outside"):
+		artifacts.resolve_remote_globs(LocalSSHClient(), remote_dir, [pattern])
+	with pytest.raises(AssertionError):
+		artifacts.pull_files(LocalSSHClient(), remote_dir, local_dir, [("../outside/x.bit", 1, 0.0)])
+	assert os.listdir(outside) == ["x.bit"]
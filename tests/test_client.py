@@ -0,0 +1,47 @@
+import time, threading
+
+from incusdev.client import RemoteClient
+
+class DeadClient:
+	def close(self):
+		pass
+
+def test_threads_losing_the_connection_together_reconnect_once(monkeypatch):
+	client = RemoteClient("host", "container", "/home/x/proj")
+	client.client = DeadClient()
+	connected = [False]
+	connects = []
+	def connect():
+		time.sleep(0.05) # long enough for the other threads to find the connection down too
+		connects.append(1)
+		connected[0] = True
+	monkeypatch.setattr(client, "connect", connect)
+	monkeypatch.setattr(client, "is_connected", lambda: connected[0])
+
+	threads = [threading.Thread(target=client.ensure_connected) for _ in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(connects) == 1
+	assert client.reconnects == 1
+
+def test_counts_are_kept_per_thread_as_well_as_in_total():
+	client = RemoteClient("host", "container", "/home/x/proj")
+	seen = {}
+	def sync(name, reconnects, resumes):
+		before = client.thread_count("reconnects")
+		for _ in range(reconnects):
+			client.add_count("reconnects")
+		for _ in range(resumes):
+			client.add_count("resumes")
+		seen[name] = client.thread_count("reconnects") - before
+
+	threads = [threading.Thread(target=sync, args=(f"unit{i}", i, 1000)) for i in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert seen == {f"unit{i}": i for i in range(8)}
+	assert client.reconnects == sum(range(8))
+	assert client.resumes == 8000
@@ -0,0 +1,12 @@
+import pytest
+
+from incusdev import compression
+
+@pytest.mark.parametrize("version, pinned", [((3, 2), True), ((3, 1), False), ((0, 0), False)])
+def test_codec_is_pinned_to_zlib_where_rsync_can_choose(monkeypatch, version, pinned):
+	monkeypatch.setattr(compression, "rsync_version", [version])
+	for policy in ["fast", "strong"]:
+		args = compression.policy_args(policy)
+		assert "-z" in args
+		assert ("--compress-choice=zlib" in args) == pinned
+	assert compression.policy_args("none") == []
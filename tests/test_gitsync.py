@@ -0,0 +1,81 @@
+import subprocess
+
+import pytest
+
+from incusdev import gitsync
+
+@pytest.fixture
+def repo(tmp_path):
+	def git(*args):
+		subprocess.run(["git", "-C", str(tmp_path), "-c", "user.name=t", "-c", "user.email=t@t"] + list(args), check=True, capture_output=True)
+	git("init", "-q")
+	(tmp_path / "a.txt").write_text("a")
+	git("add", "a.txt")
+	git("commit", "-q", "-m", "a")
+	(tmp_path / "a.txt").write_text("changed")
+	(tmp_path / "b.txt").write_text("new")
+	return str(tmp_path)
+
+@pytest.mark.parametrize("ignore_submodules", [False, True])
+def test_list_dirty_paths_only_looks_in_submodules_when_asked(repo, monkeypatch, ignore_submodules):
+	calls = []
+	run_git = gitsync.run_git
+	monkeypatch.setattr(gitsync, "run_git", lambda git_root, args, stdin=None: calls.append(args) or run_git(git_root, args, stdin))
+
+	changed, deleted = gitsync.list_dirty_paths(repo, gitsync.get_head(repo), ignore_submodules)
+	assert changed == {"a.txt", "b.txt"} and deleted == set()
+	diff_args = [args for args in calls if args[0] == "diff"][0]
+	assert ("--ignore-submodules=all" in diff_args) == ignore_submodules
+
+def git(root, *args):
+	subprocess.run(["git", "-C", str(root), "-c", "user.name=t", "-c", "user.email=t@t", "-c", "protocol.file.allow=always"] + list(args), check=True, capture_output=True)
+
+@pytest.fixture
+def superproject(tmp_path):
+	""" A superproject with one submodule checked out at sub/, both committed and clean. """
+	library, top = tmp_path / "library", tmp_path / "top"
+	for root in [library, top]:
+		root.mkdir()
+		git(root, "init", "-q")
+		(root / "s.txt").write_text("s")
+		git(root, "add", "s.txt")
+		git(root, "commit", "-q", "-m", "s")
+	git(top, "submodule", "add", "-q", str(library), "sub")
+	git(top, "commit", "-q", "-m", "sub")
+	return top
+
+def test_compute_changes_with_submodules_needs_a_full_sync(superproject):
+	_, _, manifest, _ = gitsync.compute_changes(str(superproject), None)
+	(superproject / "sub" / "s.txt").write_text("edited")
+	(superproject / "sub" / "new.txt").write_text("new")
+
+	to_send, to_delete, _, _ = gitsync.compute_changes(str(superproject), manifest)
+	assert to_send is None and to_delete is None
+
+def test_compute_changes_finds_submodule_edits_in_the_submodule_unit(superproject):
+	units = gitsync.discover_sync_units(str(superproject))
+	assert [(root, submodules) for root, submodules in units] == [(str(superproject), ["sub"]), (str(superproject / "sub"), [])]
+	manifests = [gitsync.compute_changes(root, None, ignore_submodules=bool(submodules))[2] for root, submodules in units]
+	(superproject / "sub" / "s.txt").write_text("edited")
+	(superproject / "sub" / "new.txt").write_text("new")
+
+	top_changes = gitsync.compute_changes(str(superproject), manifests[0], ignore_submodules=True)
+	assert top_changes[:2] == ([], []) and top_changes[2] == manifests[0]
+	to_send, to_delete, new_manifest, _ = gitsync.compute_changes(str(superproject / "sub"), manifests[1])
+	assert to_send == ["new.txt", "s.txt"] and to_delete == []
+	assert new_manifest != manifests[1]
+
+def test_compute_changes_sends_mode_changes_and_leaves_unchanged_links(tmp_path):
+	(tmp_path / "run.sh").write_text("echo")
+	(tmp_path / "link").symlink_to("run.sh")
+	git(tmp_path, "init", "-q")
+	git(tmp_path, "add", ".")
+	git(tmp_path, "commit", "-q", "-m", "a")
+	(tmp_path / "link").unlink()
+	(tmp_path / "link").symlink_to("run.sh") # recreated, so git looks at it again, but the same
+	_, _, manifest, _ = gitsync.compute_changes(str(tmp_path), None)
+
+	(tmp_path / "run.sh").chmod(0o755)
+	to_send, to_delete, new_manifest, _ = gitsync.compute_changes(str(tmp_path), manifest)
+	assert to_send == ["run.sh"] and to_delete == []
+	assert new_manifest["dirty"]["run.sh"].startswith("100755 ")
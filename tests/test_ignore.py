@@ -0,0 +1,38 @@
+import os
+
+from incusdev import ignore
+
+def make_tree(root, files):
+	for path, content in files.items():
+		path = os.path.join(root, path)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write(content)
+
+def test_anchored_exclude_rules_kept_when_syncing_from_the_git_root(tmp_path):
+	make_tree(tmp_path, {".git/info/exclude": "/build\n", "build/out.o": "x", "src/build/keep.c": "x", "src/main.c": "x"})
+	rules = ignore.IgnoreRules(str(tmp_path))
+
+	assert "- /build" in rules.rsync_filter_rules()
+	assert sorted(rules.walk()) == ["src/build/keep.c", "src/main.c"]
+
+def test_anchored_exclude_rules_rebased_for_a_subdirectory(tmp_path):
+	make_tree(tmp_path, {".git/info/exclude": "/sub/build\n/other\n", "sub/build/out.o": "x", "sub/main.c": "x"})
+	rules = ignore.IgnoreRules(str(tmp_path / "sub"))
+
+	assert rules.rsync_filter_rules() == ["- /build"]
+	assert list(rules.walk()) == ["main.c"]
+
+def test_walk_does_not_go_into_git(tmp_path):
+	make_tree(tmp_path, {".git/objects/ab/cdef": "x", ".git/HEAD": "ref", "main.c": "x"})
+	rules = ignore.IgnoreRules(str(tmp_path))
+
+	assert list(rules.walk()) == ["main.c"]
+	assert rules.stats["ignored_files"] == 0
+
+def test_walk_leaves_out_skip_paths(tmp_path):
+	make_tree(tmp_path, {"sub/lib/a.c": "x", "sub/.gitignore": "*.c\n", "other/sub/b.c": "x", "main.c": "x"})
+	rules = ignore.IgnoreRules(str(tmp_path))
+
+	assert sorted(rules.walk(skip_paths={"sub"})) == ["main.c", "other/sub/b.c"]
+	assert "sub" not in rules.rulesets
@@ -0,0 +1,98 @@
+import os, sys, json, multiprocessing
+
+import pytest
+
+from incusdev import pool, progress
+
+FAKE_INCUS = f"{sys.executable} {os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_incus.py')}"
+
+@pytest.fixture
+def fake_incus(tmp_path, monkeypatch):
+	""" A fake incus with a template container and its pool snapshot, and a working directory under a 'home'. """
+	state_path = tmp_path / "incus.json"
+	state_path.write_text(json.dumps({"tmpl": {"config": {pool.SNAPSHOT_KEY: "snap0"}}}))
+	monkeypatch.setenv("FAKE_INCUS_STATE", str(state_path))
+	monkeypatch.setenv("HOME", str(tmp_path)) # for the pool's lock file
+	monkeypatch.setenv("INCUSDEV_COMPRESSION", "none")
+	local_dir = tmp_path / "home" / "x" / "proj"
+	local_dir.mkdir(parents=True)
+	return state_path, str(local_dir)
+
+def add_ready_members(state_path, count):
+	instances = json.loads(state_path.read_text())
+	for i in range(count):
+		instances[f"tmpl-pool-{i}"] = {"config": {pool.POOL_KEY: "tmpl", pool.STATE_KEY: "ready", pool.CREATED_KEY: str(1000 + i)}}
+	state_path.write_text(json.dumps(instances))
+
+def acquire_in_process(local_dir, results):
+	container_pool = pool.ContainerPool("tmpl", local_dir, incus_cmd=FAKE_INCUS)
+	container_pool.sync_into = lambda name: None
+	results.put(container_pool.acquire(refill=False))
+
+def test_acquire_hands_each_member_to_one_process(fake_incus, monkeypatch):
+	state_path, local_dir = fake_incus
+	add_ready_members(state_path, 4)
+	monkeypatch.setenv("FAKE_INCUS_DELAY", "0.05") # so the processes overlap
+
+	context = multiprocessing.get_context("fork")
+	results = context.Queue()
+	processes = [context.Process(target=acquire_in_process, args=(local_dir, results)) for _ in range(4)]
+	for process in processes:
+		process.start()
+	for process in processes:
+		process.join()
+
+	names = [results.get(timeout=5) for _ in processes]
+	assert sorted(names) == [f"tmpl-pool-{i}" for i in range(4)]
+	instances = json.loads(state_path.read_text())
+	assert all(instances[name]["config"][pool.STATE_KEY] == "in_use" for name in names)
+
+def refill_in_process(local_dir):
+	container_pool = pool.ContainerPool("tmpl", local_dir, size=2, incus_cmd=FAKE_INCUS)
+	container_pool.sync_into = lambda name: None
+	container_pool.refill()
+
+def test_refills_at_once_dont_overshoot_the_size(fake_incus, monkeypatch):
+	state_path, local_dir = fake_incus
+	monkeypatch.setenv("FAKE_INCUS_DELAY", "0.05")
+
+	context = multiprocessing.get_context("fork")
+	processes = [context.Process(target=refill_in_process, args=(local_dir,)) for _ in range(3)]
+	for process in processes:
+		process.start()
+	for process in processes:
+		process.join()
+
+	members = pool.ContainerPool("tmpl", local_dir, incus_cmd=FAKE_INCUS).list_members()
+	assert sorted(state for _, state, _ in members) == ["ready", "ready"]
+
+def test_acquire_from_empty_pool_never_marks_the_clone_ready(fake_incus):
+	state_path, local_dir = fake_incus
+	container_pool = pool.ContainerPool("tmpl", local_dir, incus_cmd=FAKE_INCUS)
+	container_pool.sync_into = lambda name: None
+
+	name = container_pool.acquire(refill=False)
+	assert container_pool.ready_members() == []
+	assert json.loads(state_path.read_text())[name]["config"][pool.STATE_KEY] == "in_use"
+
+def test_release_and_drain_delete_members(fake_incus):
+	state_path, local_dir = fake_incus
+	add_ready_members(state_path, 2)
+	container_pool = pool.ContainerPool("tmpl", local_dir, incus_cmd=FAKE_INCUS)
+	container_pool.sync_into = lambda name: None
+
+	name = container_pool.acquire(refill=False)
+	container_pool.drain() # leaves the one in use
+	assert [m[0] for m in container_pool.list_members()] == [name]
+	container_pool.release(name)
+	assert container_pool.list_members() == []
+
+@pytest.mark.parametrize("delete", [False, True])
+def test_sync_out_of_only_deletes_host_files_when_asked(fake_incus, monkeypatch, delete):
+	state_path, local_dir = fake_incus
+	commands = []
+	monkeypatch.setattr(progress, "run_rsync_resumable", lambda cmd, on_progress=None: commands.append(cmd))
+
+	pool.ContainerPool("tmpl", local_dir, incus_cmd=FAKE_INCUS).sync_out_of("tmpl-pool-0", delete=delete)
+	assert ("--delete" in commands[0]) == delete
+	assert "--update" in commands[0]
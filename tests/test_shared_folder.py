@@ -0,0 +1,56 @@
+import os, json
+
+from incusdev import shared_folder
+
+class FakeClient:
+	""" Records what benchmark() does, copying files as rsync would, and building by adding a file. """
+
+	def __init__(self, local_dir):
+		self.incus_container_name = "c"
+		self.local_working_directory = local_dir
+		self.remote_working_directory = shared_folder.remote_filename_from_local(local_dir)
+		self.shared_folder = None
+		self.calls = []
+
+	def rsync_to_container(self, delete):
+		self.calls.append(("to", self.local_working_directory, self.remote_working_directory, delete))
+
+	def rsync_from_container(self, delete):
+		self.calls.append(("from", self.local_working_directory, self.remote_working_directory, delete))
+
+	def execute_batch(self, commands, **kwargs):
+		self.calls.append(("build", self.local_working_directory, self.remote_working_directory))
+		assert os.path.exists(os.path.join(self.local_working_directory, "main.c"))
+
+	def execute_commands(self, command, **kwargs):
+		self.calls.append(("exec", command))
+
+def test_benchmark_only_touches_a_scratch_copy(tmp_path, monkeypatch):
+	devices = {}
+	def fake_incus(incus_cmd, *args, check=True):
+		if args[0] == "query":
+			return json.dumps({"devices": devices})
+		if args[:3] == ("config", "device", "add"):
+			devices[args[4]] = dict([arg.split("=", 1) for arg in args[6:]], type=args[5])
+		elif args[:3] == ("config", "device", "remove"):
+			del devices[args[4]]
+		return ""
+	monkeypatch.setattr(shared_folder, "run_incus", fake_incus)
+
+	local_dir = tmp_path / "home" / "x" / "proj"
+	local_dir.mkdir(parents=True)
+	(local_dir / "main.c").write_text("int main;")
+	client = FakeClient(str(local_dir))
+	original = (client.local_working_directory, client.remote_working_directory)
+
+	timings = shared_folder.benchmark(client, "make", repeats=2)
+	assert len(timings["rsync"]) == 2 and len(timings["shared_folder"]) == 2
+
+	scratch_dir = str(local_dir) + shared_folder.SCRATCH_SUFFIX
+	synced = [call for call in client.calls if call[0] in ["to", "from", "build"]]
+	assert synced and all(call[1] == scratch_dir for call in synced)
+	assert ("exec", f"rm -rf {shared_folder.remote_filename_from_local(scratch_dir)}") in client.calls
+	assert not os.path.exists(scratch_dir)
+	assert os.listdir(local_dir) == ["main.c"]
+	assert devices == {}
+	assert (client.local_working_directory, client.remote_working_directory) == original
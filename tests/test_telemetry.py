@@ -0,0 +1,24 @@
+import subprocess
+
+from incusdev import telemetry
+
+class GoneSource:
+	""" A source for a container that stopped before the first sample. """
+
+	def read(self):
+		raise subprocess.CalledProcessError(1, "incus")
+
+	def close(self):
+		pass
+
+def test_collector_stops_quietly_when_the_first_read_fails(tmp_path, monkeypatch):
+	collector = telemetry.TelemetryCollector("c", interval_sec=0.01, output_path=str(tmp_path / "t.csv"))
+	monkeypatch.setattr(collector, "open_source", GoneSource)
+	errors = []
+	monkeypatch.setattr(telemetry.threading, "excepthook", errors.append)
+
+	with collector:
+		collector._thread.join(timeout=5)
+		assert not collector._thread.is_alive()
+	assert errors == []
+	assert collector.rows == []